@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+imgcry的性能测试，结果保存为JSON，并和基准比较
+"""
+
+import json
+import platform
+import sys
+import timeit
+from argparse import ArgumentParser
+from io import BytesIO
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import imgcry
+from sample_images import make_image, to_jpeg
+
+# 名字 -> (宽, 高)
+IMAGE_SIZES = {
+    'master1200':  (1200, 848),   # P站master1200的一般尺寸
+    'manga':       (848, 1200),   # 竖的漫画页
+    'manga_tall':  (690, 4000),   # 很长的条漫
+    'webtoon':     (690, 20000),  # 特别长的条漫，分条反色主要为了这种
+    'large':       (1500, 2000),  # 最短边超过1080，会缩小
+}
+
+
+def measure(func, number, repeat):
+    """返回每次调用的最短秒数"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def run(repeat):
+    results = {}
+
+    rng = imgcry.Random(114514)
+    results['random.random'] = measure(rng.random, 100000, repeat)
+    results['random_sequence.init'] = measure(lambda: imgcry.RandomSequence(20000, 114514), 10, repeat)
+
+    def next_all():
+        seq = imgcry.RandomSequence(20000, 114514)
+        for _ in range(20000):
+            seq.next()
+    results['random_sequence.next'] = measure(next_all, 1, repeat) / 20000
+    results['random_sequence.fast'] = measure(lambda: imgcry._random_sequence(20000, 114514), 1, repeat) / 20000
+
+    for name, (width, height) in IMAGE_SIZES.items():
+        data = to_jpeg(make_image(width, height))
+
+        def load():
+            img_ = Image.open(BytesIO(data))
+            img_.load()
+            return img_
+
+        img = load()
+        resized = imgcry._limit_size(img)
+        results[f'{name}.decode'] = measure(load, 1, repeat)
+        results[f'{name}.resize'] = measure(lambda: imgcry._limit_size(img), 1, repeat)
+        results[f'{name}.invert_numpy'] = measure(lambda: imgcry._invert_blocks_numpy(resized), 1, repeat)
+        results[f'{name}.invert_strips'] = measure(lambda: imgcry._invert_blocks_strips(resized.copy()), 1, repeat)
+        results[f'{name}.invert_pil'] = measure(lambda: imgcry._invert_blocks_pil(resized.copy()), 1, repeat)
+        results[f'{name}.shuffle'] = measure(lambda: imgcry._shuffle_blocks(resized, 114514), 1, repeat)
+        results[f'{name}.save'] = measure(lambda: imgcry._save_jpeg(resized), 1, repeat)
+        results[f'{name}.encrypt_image'] = measure(lambda: imgcry.encrypt_image(data), 1, repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """打印对比，返回变慢超过threshold的项目"""
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            print(f'{name:32} {seconds * 1000:12.4f}ms')
+            continue
+        ratio = seconds / baseline[name]
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = '  变慢'
+            regressions.append(name)
+        print(f'{name:32} {seconds * 1000:12.4f}ms  基准{baseline[name] * 1000:12.4f}ms  {ratio:6.2f}x{mark}')
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='imgcry性能测试')
+    parser.add_argument('--output', default='benchmark_result.json', help='结果保存路径')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='基准路径')
+    parser.add_argument('--save-baseline', action='store_true', help='把结果保存为基准')
+    parser.add_argument('--threshold', type=float, default=0.2, help='比基准慢多少算变慢')
+    parser.add_argument('--repeat', type=int, default=5, help='每项重复几次取最快')
+    args = parser.parse_args()
+
+    result = {
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'numpy':  np.__version__,
+            'machine': platform.machine()
+        },
+        'results': run(args.repeat)
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    except FileNotFoundError:
+        baseline = {}
+    regressions = compare(result['results'], baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+        print('已保存基准：' + args.baseline)
+    if regressions:
+        print('变慢的项目：' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
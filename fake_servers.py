@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+本地模拟的P站和微博服务器，用来测试和压测，可以设置延迟、带宽和出错概率
+"""
+
+import asyncio
+import json
+import random
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+import rsa
+from aiohttp import web
+
+from sample_images import make_array, to_image, to_jpeg
+
+# 名字 -> 原来的origin，每个服务用一个端口
+SERVICES = (
+    ('pixiv',      'https://www.pixiv.net'),
+    ('pximg',      'https://i.pximg.net'),
+    ('sina_login', 'https://login.sina.com.cn'),
+    ('picupload',  'https://picupload.weibo.com'),
+    ('weibo',      'https://weibo.com'),
+)
+CHUNK_SIZE = 16 * 1024
+
+
+@lru_cache(maxsize=64)
+def _make_image(width, height, seed):
+    arr = make_array(width, height, seed, noise=32)
+    # 每张图加个随机色块，让缩略图的感知哈希不一样
+    rng = np.random.RandomState(seed)
+    block_x, block_y = rng.randint(0, width // 2), rng.randint(0, height // 2)
+    arr[block_y:block_y + height // 2, block_x:block_x + width // 2] = rng.randint(0, 256, 3)
+    return to_jpeg(to_image(arr))
+
+
+class FakeServers:
+    def __init__(self, host='localhost', port=18000, latency=0., bandwidth=0, error_rate=0.,
+                 ranking_size=100, page_count=3, image_size=(1200, 848), seed=0):
+        """
+        :param host: 监听的地址
+        :param port: 第一个服务的端口，之后的服务依次加1
+        :param latency: 每个请求的延迟秒数
+        :param bandwidth: 每个请求的带宽，字节/秒，为0则不限制
+        :param error_rate: 返回503的概率
+        :param ranking_size: 每类排行榜的图数
+        :param page_count: 每个图的页数
+        :param image_size: 原图尺寸
+        """
+        self._host = host
+        self._port = port
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._error_rate = error_rate
+        self._ranking_size = ranking_size
+        self._page_count = page_count
+        self._image_size = image_size
+        self._random = random.Random(seed)
+        self._pubkey, self._privkey = rsa.newkeys(1024)
+
+        # 请求数、注入的错误数、上传数、发微博数等
+        self.stats = Counter()
+        self._runner = None
+
+    @property
+    def base_urls(self):
+        """原来的origin -> 模拟服务器的origin，用作Transport的base_urls"""
+        return {origin: self._get_origin(name) for name, origin in SERVICES}
+
+    def _get_origin(self, name):
+        index = [name_ for name_, _ in SERVICES].index(name)
+        return f'http://{self._host}:{self._port + index}'
+
+    async def start(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get('/ranking.php', self._ranking)
+        app.router.add_get('/img-master/img/{path:.*}', self._image)
+        app.router.add_get('/c/{size}/img-master/img/{path:.*}', self._thumbnail)
+        app.router.add_get('/sso/prelogin.php', self._prelogin)
+        app.router.add_post('/sso/login.php', self._login)
+        app.router.add_get('/', self._weibo_index)
+        app.router.add_get('/home', self._weibo_home)
+        app.router.add_post('/interface/pic_upload.php', self._upload)
+        app.router.add_post('/aj/mblog/add', self._post)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        for index in range(len(SERVICES)):
+            await web.TCPSite(self._runner, self._host, self._port + index).start()
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.stats['requests'] += 1
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        if self._error_rate and self._random.random() < self._error_rate:
+            self.stats['injected_errors'] += 1
+            return web.Response(status=503)
+        return await handler(request)
+
+    async def _send(self, request, body, content_type):
+        """按带宽限制发送"""
+        response = web.StreamResponse(headers={'Content-Type': content_type})
+        response.content_length = len(body)
+        await response.prepare(request)
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            await response.write(chunk)
+            if self._bandwidth:
+                await asyncio.sleep(len(chunk) / self._bandwidth)
+        await response.write_eof()
+        self.stats['bytes_sent'] += len(body)
+        return response
+
+    async def _read_body(self, request):
+        """按带宽限制接收"""
+        size = 0
+        async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if self._bandwidth:
+                await asyncio.sleep(len(chunk) / self._bandwidth)
+        self.stats['bytes_received'] += size
+        return size
+
+    def _is_logged_in(self, request):
+        return request.cookies.get('SUB') == 'fake'
+
+    async def _ranking(self, request):
+        mode = request.query['mode']
+        page = int(request.query.get('p', 1))
+        first = (page - 1) * 50
+        if first >= self._ranking_size:
+            return web.json_response({'error': 'not found'}, status=404)
+        # 不同类有一部分重复的图
+        id_offset = 1000000 + (sum(map(ord, mode)) % 10) * 20
+        contents = []
+        for rank in range(first + 1, min(first + 50, self._ranking_size) + 1):
+            illust_id = id_offset + rank
+            contents.append({
+                'illust_id':               illust_id,
+                'rank':                    rank,
+                'title':                   f'title {illust_id}',
+                'user_name':               f'user {illust_id % 97}',
+                'tags':                    ['tag'],
+                'illust_content_type':     {'bl': False},
+                'illust_upload_timestamp': 1546300800 + illust_id,
+                'illust_page_count':       str(self._page_count),
+                'url': f'https://i.pximg.net/c/240x480/img-master/img/2019/01/01/09/00/00/{illust_id}_p0_master1200.jpg'
+            })
+        next_page = page + 1 if first + 50 < self._ranking_size else False
+        body = json.dumps({'contents': contents, 'next': next_page}).encode()
+        return await self._send(request, body, 'application/json')
+
+    async def _image(self, request):
+        # 每页都不一样，不然加密后的图一样会命中上传缓存
+        width, height = self._image_size
+        image_seed = zlib.crc32(request.path.encode())
+        return await self._send(request, _make_image(width, height, image_seed), 'image/jpeg')
+
+    async def _thumbnail(self, request):
+        image_seed = zlib.crc32(request.path.encode())
+        return await self._send(request, _make_image(240, 170, image_seed), 'image/jpeg')
+
+    async def _prelogin(self, request):
+        data = {
+            'retcode':    0,
+            'servertime': int(time.time()),
+            'pcid':       'fake',
+            'nonce':      'FAKENONCE',
+            'pubkey':     format(self._pubkey.n, 'x'),
+            'rsakv':      '1',
+            'showpin':    0
+        }
+        return web.Response(text=f'{request.query.get("callback", "")}({json.dumps(data)})')
+
+    async def _login(self, request):
+        await request.post()
+        self.stats['logins'] += 1
+        response = web.Response(text=f'<script>location.replace("{self._get_origin("weibo")}/home");</script>',
+                                content_type='text/html')
+        response.set_cookie('SUB', 'fake')
+        return response
+
+    async def _weibo_index(self, request):
+        if self._is_logged_in(request):
+            raise web.HTTPFound('/home')
+        return web.Response(text='not logged in')
+
+    async def _weibo_home(self, request):
+        return web.Response(text='home')
+
+    async def _upload(self, request):
+        await self._read_body(request)
+        if not self._is_logged_in(request):
+            raise web.HTTPFound('https://login.sina.com.cn/sso/login.php')
+        self.stats['uploads'] += 1
+        pid = '%032x' % self._random.getrandbits(128)
+        raise web.HTTPFound(f'https://weibo.com/aj/static/upimgback.html?_wv=5&callback=STK_ijax_1&ret=1&pid={pid}')
+
+    async def _post(self, request):
+        await request.post()
+        if not self._is_logged_in(request):
+            return web.json_response({'code': '100002'})
+        self.stats['posts'] += 1
+        return web.json_response({'code': '100000'})
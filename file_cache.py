@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+
+class FileCache:
+    """磁盘缓存，文件名是key的哈希，总大小超过max_size字节时删除最久没用的"""
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+        # 文件名 -> 大小，按最后访问时间升序
+        self._entries = OrderedDict()
+        self._size = 0
+        entries = []
+        for entry in os.scandir(path):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    @staticmethod
+    def _get_name(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def __contains__(self, key):
+        return self._get_name(key) in self._entries
+
+    def open(self, key):
+        """返回只读的二进制文件对象，没有则返回None"""
+        name = self._get_name(key)
+        if name not in self._entries:
+            self.misses += 1
+            return None
+        path = os.path.join(self._path, name)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            self._size -= self._entries.pop(name)
+            self.misses += 1
+            return None
+        # 用mtime记录最后访问时间，重启后也能按LRU删除
+        os.utime(path)
+        self._entries.move_to_end(name)
+        self.hits += 1
+        return f
+
+    def get(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def set(self, key, data):
+        self.set_file(key, BytesIO(data))
+
+    def set_file(self, key, f):
+        """从文件对象的当前位置复制到缓存"""
+        name = self._get_name(key)
+        # 先写临时文件再重命名，保证不会读到写了一半的文件
+        with NamedTemporaryFile(dir=self._path, prefix='.', delete=False) as tmp_file:
+            shutil.copyfileobj(f, tmp_file)
+            size = tmp_file.tell()
+        os.replace(tmp_file.name, os.path.join(self._path, name))
+
+        self._size -= self._entries.pop(name, 0)
+        self._entries[name] = size
+        self._size += size
+        self._evict()
+
+    def clear(self):
+        for name in self._entries:
+            try:
+                os.remove(os.path.join(self._path, name))
+            except FileNotFoundError:
+                pass
+        self._entries.clear()
+        self._size = 0
+
+    def _evict(self):
+        while self._size > self._max_size and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self._path, name))
+            except FileNotFoundError:
+                pass
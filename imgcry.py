@@ -2,9 +2,12 @@
 
 import math
 import re
+import struct
 import time
+from functools import lru_cache
 from io import BytesIO
 
+import numpy as np
 from PIL import Image, ImageOps
 
 
@@ -27,9 +30,10 @@ class Random:
 
     @staticmethod
     def _hash_code(s):
+        # 和JS的charCodeAt一样按UTF-16码元算，BMP以外的字符是两个码元
         hash_ = 0
-        for c in s:
-            hash_ = (hash_ * 31 + ord(c)) & 0xFFFFFFFF
+        for c, in struct.iter_unpack('<H', s.encode('utf-16-le', 'surrogatepass')):
+            hash_ = (hash_ * 31 + c) & 0xFFFFFFFF
         return hash_
 
     def random(self):
@@ -63,30 +67,9 @@ class RandomSequence:
         return result
 
 
-def encrypt_image(data, seed=114514):
-    f = BytesIO(data)
-    img = Image.open(f)
-
-    # 最短边长超过1080的会被微博压缩
-    min_size = min(img.width, img.height)
-    if min_size > 1080:
-        scale = 1080 / min_size
-        img = img.resize((round(img.width * scale), round(img.height * scale)), Image.BICUBIC)
-
-    # https://github.com/xfgryujk/weibo-img-crypto/blob/8083e7288d188e430ba84aa33c2f01afefa90523/src/codec.js#L160
-    # block_width = img.width // 8
-    # block_height = img.height // 8
-    # new_img = Image.new('RGB', (block_width * 8, block_height * 8))
-    # seq = RandomSequence(block_width * block_height, seed)
-    # for block_y in range(block_height):
-    #     for block_x in range(block_width):
-    #         index = seq.next()
-    #         new_block_x = index % block_width
-    #         new_block_y = index // block_width
-    #         block = img.crop((block_x * 8, block_y * 8, (block_x + 1) * 8, (block_y + 1) * 8))
-    #         new_img.paste(block, (new_block_x * 8, new_block_y * 8))
-
-    # https://github.com/xfgryujk/weibo-img-crypto/blob/dc9b5f2a8a2163ac11d076aaac3d68a03a49b795/src/codec.js#L206
+# https://github.com/xfgryujk/weibo-img-crypto/blob/dc9b5f2a8a2163ac11d076aaac3d68a03a49b795/src/codec.js#L206
+def _invert_blocks_pil(img):
+    """参考实现，逐块反色，很慢"""
     invert_first = True
     for y in range(0, img.height, 8):
         height = min(8, img.height - y)
@@ -96,7 +79,208 @@ def encrypt_image(data, seed=114514):
             block = ImageOps.invert(block)
             img.paste(block, (x, y))
         invert_first = not invert_first
+    return img
+
+
+def _checkerboard_mask(height, width, first_row=0):
+    """
+    8x8块的棋盘格，True表示要反色，左上角的块反色
+    :param first_row: 这部分在整张图里的起始行，用来算块的奇偶
+    """
+    block_y = ((np.arange(height) + first_row) >> 3)[:, None]
+    block_x = (np.arange(width) >> 3)[None, :]
+    return ((block_y + block_x) & 1) == 0
+
+
+def _invert_blocks_numpy(img):
+    """和_invert_blocks_pil结果相同，但是整张图一次反色"""
+    if img.mode not in ('L', 'RGB'):
+        # 和ImageOps.invert一样不支持其他模式
+        raise IOError('not supported for this image mode')
+    arr = np.array(img)
+    mask = _checkerboard_mask(img.height, img.width)
+    if arr.ndim == 3:
+        mask = mask[:, :, None]
+    np.subtract(255, arr, out=arr, where=mask)
+    return Image.fromarray(arr, img.mode)
+
+
+# 分条反色时每条的行数，是8的倍数
+STRIP_HEIGHT = 256
+
+
+def _invert_blocks_strips(img, strip_height=STRIP_HEIGHT):
+    """
+    和_invert_blocks_numpy结果相同，但是原地修改，每次只复制strip_height行，
+    临时内存只和宽度成正比，适合很长的条漫
+    """
+    if img.mode not in ('L', 'RGB'):
+        raise IOError('not supported for this image mode')
+    if strip_height % 8 != 0:
+        raise ValueError('strip_height必须是8的倍数')
+    for y in range(0, img.height, strip_height):
+        box = (0, y, img.width, min(y + strip_height, img.height))
+        arr = np.array(img.crop(box))
+        mask = _checkerboard_mask(arr.shape[0], img.width, y)
+        if arr.ndim == 3:
+            mask = mask[:, :, None]
+        np.subtract(255, arr, out=arr, where=mask)
+        img.paste(Image.fromarray(arr, img.mode), box)
+    return img
+
+
+INVERT_ENGINES = {
+    'pil':    _invert_blocks_pil,
+    'numpy':  _invert_blocks_numpy,
+    'strips': _invert_blocks_strips
+}
+
+
+def _random_sequence(length, seed):
+    """和RandomSequence(length, seed)调用length次next()的结果相同，把Random内联了所以快很多"""
+    s0, s1 = Random(seed)._rng_state
+    list_ = list(range(length))
+    for next_min in range(length):
+        s0 = 18030 * (s0 & 0xFFFF) + ((s0 & 0xFFFFFFFF) >> 16)
+        s1 = 36969 * (s1 & 0xFFFF) + ((s1 & 0xFFFFFFFF) >> 16)
+        x = ((s0 << 16) & 0xFFFFFFFF) + (s1 & 0xFFFF)
+        index = int(math.floor(next_min + x * 2.3283064365386962890625e-10 * (length - next_min)))
+        list_[index], list_[next_min] = list_[next_min], list_[index]
+    return list_
+
+
+@lru_cache(maxsize=32)
+def _shuffle_permutation(length, seed):
+    """第i块移到第result[i]块的位置"""
+    result = np.array(_random_sequence(length, seed), dtype=np.intp)
+    result.flags.writeable = False
+    return result
+
+
+def _to_blocks(img):
+    """返回(块数, 8, 8, 通道数)的数组，不足8像素的边缘被裁掉"""
+    block_width = img.width // 8
+    block_height = img.height // 8
+    arr = np.asarray(img)[:block_height * 8, :block_width * 8]
+    arr = arr.reshape(block_height, 8, block_width, 8, -1).swapaxes(1, 2)
+    return arr.reshape(block_height * block_width, 8, 8, -1), block_width, block_height
+
+
+def _from_blocks(blocks, block_width, block_height, mode):
+    arr = blocks.reshape(block_height, block_width, 8, 8, -1).swapaxes(1, 2)
+    arr = arr.reshape(block_height * 8, block_width * 8, -1)
+    if arr.shape[2] == 1:
+        arr = arr[:, :, 0]
+    return Image.fromarray(np.ascontiguousarray(arr), mode)
+
+
+# https://github.com/xfgryujk/weibo-img-crypto/blob/8083e7288d188e430ba84aa33c2f01afefa90523/src/codec.js#L160
+def _shuffle_blocks(img, seed):
+    if img.width < 8 or img.height < 8:
+        # 一个完整的块都没有，和JS版一样不变
+        return img
+    blocks, block_width, block_height = _to_blocks(img)
+    permutation = _shuffle_permutation(len(blocks), seed)
+    new_blocks = np.empty_like(blocks)
+    new_blocks[permutation] = blocks
+    return _from_blocks(new_blocks, block_width, block_height, img.mode)
 
+
+def _unshuffle_blocks(img, seed):
+    if img.width < 8 or img.height < 8:
+        return img
+    blocks, block_width, block_height = _to_blocks(img)
+    permutation = _shuffle_permutation(len(blocks), seed)
+    return _from_blocks(blocks[permutation], block_width, block_height, img.mode)
+
+
+def _encrypt(img, seed, mode, engine):
+    if mode == 'invert':
+        return INVERT_ENGINES[engine](img)
+    elif mode == 'shuffle':
+        return _shuffle_blocks(img, seed)
+    raise ValueError('未知的加密模式：' + mode)
+
+
+def _decrypt(img, seed, mode):
+    if mode == 'invert':
+        # 再反色一次就还原了
+        return _invert_blocks_strips(img)
+    elif mode == 'shuffle':
+        return _unshuffle_blocks(img, seed)
+    raise ValueError('未知的加密模式：' + mode)
+
+
+# 限制文件大小时最低的JPEG质量
+MIN_JPEG_QUALITY = 70
+
+
+def _save_jpeg(img, max_bytes=0):
+    """
+    :param max_bytes: 最大字节数，为0则用最高质量
+    """
+    data = _save_jpeg_quality(img, 'maximum')  # 大概减少一半文件尺寸
+    if not max_bytes or len(data) <= max_bytes:
+        return data
+
+    # 二分查找不超过max_bytes的最高质量，最多试5次
+    # 固定用4:4:4采样，4:2:0的色度块是16x16的，会把相邻的反色块和不反色块混在一起
+    low, high = MIN_JPEG_QUALITY, 100
+    best_data = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = _save_jpeg_quality(img, quality)
+        if len(data) <= max_bytes:
+            best_data = data
+            low = quality + 1
+        else:
+            high = quality - 1
+    # 最低质量也超了就用最低质量
+    return best_data if best_data is not None else data
+
+
+def _save_jpeg_quality(img, quality):
     f = BytesIO()
-    img.save(f, 'JPEG', quality='maximum')  # 大概减少一半文件尺寸
+    if quality == 'maximum':
+        img.save(f, 'JPEG', quality=quality)
+    else:
+        img.save(f, 'JPEG', quality=quality, subsampling=0)
     return f.getvalue()
+
+
+def _get_limited_size(width, height):
+    # 最短边长超过1080的会被微博压缩
+    min_size = min(width, height)
+    if min_size <= 1080:
+        return width, height
+    scale = 1080 / min_size
+    return round(width * scale), round(height * scale)
+
+
+def _limit_size(img, size=None):
+    if size is None:
+        size = _get_limited_size(img.width, img.height)
+    if img.size != size:
+        img = img.resize(size, Image.BICUBIC)
+    return img
+
+
+def encrypt_image(data, seed=114514, mode='invert', engine='strips', max_bytes=0):
+    """
+    :param data: 原图的bytes或二进制文件对象
+    :param max_bytes: 加密后JPEG的最大字节数，为0则用最高质量
+    """
+    img = Image.open(data if hasattr(data, 'read') else BytesIO(data))
+    size = _get_limited_size(img.width, img.height)
+    if size != img.size:
+        # 要缩小时让JPEG解码器直接按1/2、1/4、1/8缩小解码，省时间和内存
+        img.draft(img.mode, size)
+    img = _limit_size(img, size)
+    img = _encrypt(img, seed, mode, engine)
+    return _save_jpeg(img, max_bytes)
+
+
+def decrypt_image(data, seed=114514, mode='invert'):
+    img = Image.open(BytesIO(data))
+    img = _decrypt(img, seed, mode)
+    return _save_jpeg(img)
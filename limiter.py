@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+
+from yarl import URL
+
+from retry import RETRYABLE_ERRORS
+
+
+class AdaptiveLimiter:
+    """
+    AIMD调整的并发数上限，和TCP拥塞控制一样：
+    请求成功且没有明显变慢则并发数慢慢加（每个请求加1/limit），出错或者延迟超过预期的latency_tolerance倍则减半。
+    预期延迟 = 固定延迟 + 大小 * 每单位延迟，两项用指数加权的线性回归估计，所以大小不同的请求也能比较
+    """
+
+    # 指数加权平均的权重
+    EWMA_ALPHA = 0.2
+    # 至少有几个样本才判断是否变慢
+    MIN_SAMPLES = 3
+
+    def __init__(self, name='', initial=2, max_limit=8, min_limit=1, latency_tolerance=2., decrease_factor=0.5):
+        """
+        :param name: 打印日志用的名字
+        :param initial: 初始并发数
+        :param max_limit: 并发数上限
+        :param min_limit: 并发数下限
+        :param latency_tolerance: 延迟超过预期的几倍算拥塞
+        :param decrease_factor: 拥塞时并发数乘以这个值
+        """
+        self._name = name
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._max_limit = max_limit
+        self._min_limit = min_limit
+        self._latency_tolerance = latency_tolerance
+        self._decrease_factor = decrease_factor
+
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        # 大小、延迟、大小的平方、大小*延迟的指数加权平均，用来估计预期延迟
+        self._samples = 0
+        self._mean_size = self._mean_latency = self._mean_size2 = self._mean_size_latency = 0.
+        # 上次减小并发数的时间，在这之前开始的请求出错不再减小，避免一次拥塞减好几次
+        self._last_decrease_time = 0.
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def request(self, size=1):
+        """
+        用法：async with limiter.request(size) as request: ...
+        把request作为aiohttp的trace_request_ctx传给Transport创建的session，则从拿到连接开始计时，不算排队和建立连接的时间
+        :param size: 请求的大小，如上传的字节数
+        """
+        return _LimitedRequest(self, size)
+
+    async def _acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    def _get_expected_latency(self, size):
+        variance = self._mean_size2 - self._mean_size ** 2
+        if variance <= 1e-9 * max(self._mean_size2, 1):
+            # 大小都差不多，直接用平均延迟
+            return self._mean_latency
+        slope = max((self._mean_size_latency - self._mean_size * self._mean_latency) / variance, 0.)
+        intercept = max(self._mean_latency - slope * self._mean_size, 0.)
+        return intercept + slope * size
+
+    def _add_sample(self, size, latency):
+        alpha = self.EWMA_ALPHA if self._samples > 0 else 1.
+        self._samples += 1
+        self._mean_size += alpha * (size - self._mean_size)
+        self._mean_latency += alpha * (latency - self._mean_latency)
+        self._mean_size2 += alpha * (size * size - self._mean_size2)
+        self._mean_size_latency += alpha * (size * latency - self._mean_size_latency)
+
+    def _update(self, start_time, size, error):
+        """根据请求结果调整并发数"""
+        congested = error
+        if not error:
+            latency = time.monotonic() - start_time
+            if self._samples >= self.MIN_SAMPLES:
+                congested = latency > self._get_expected_latency(size) * self._latency_tolerance
+            self._add_sample(size, latency)
+
+        if not congested:
+            self._limit = min(self._limit + 1 / self._limit, self._max_limit)
+        elif start_time >= self._last_decrease_time:
+            self._limit = max(self._limit * self._decrease_factor, self._min_limit)
+            self._last_decrease_time = time.monotonic()
+            print(f'{self._name}{"出错" if error else "变慢"}，并发数降到{self.limit}')
+
+    async def _release(self):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+
+class _LimitedRequest:
+    def __init__(self, limiter, size):
+        self._limiter = limiter
+        self._size = size
+        self._start_time = None
+
+    def on_connected(self):
+        """拿到连接了，重新开始计时"""
+        self._start_time = time.monotonic()
+
+    async def __aenter__(self):
+        await self._limiter._acquire()
+        # 没有Transport的trace时从拿到并发名额开始计时
+        self._start_time = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # 网络错误算拥塞，取消、登录失效等其他异常不算
+        error = exc_type is not None and issubclass(exc_type, RETRYABLE_ERRORS)
+        if exc_type is None or error:
+            self._limiter._update(self._start_time, self._size, error)
+        await self._limiter._release()
+
+
+class HostLimiters:
+    """每个host一个AdaptiveLimiter"""
+
+    def __init__(self, max_concurrency=None, default_max_concurrency=8):
+        """
+        :param max_concurrency: host -> 并发数上限，如{"picupload.weibo.com": 3}
+        :param default_max_concurrency: 其他host的并发数上限
+        """
+        self._max_concurrency = max_concurrency or {}
+        self._default_max_concurrency = default_max_concurrency
+        self._limiters = {}
+
+    def get(self, url):
+        host = URL(url).host
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            max_limit = self._max_concurrency.get(host, self._default_max_concurrency)
+            limiter = self._limiters[host] = AdaptiveLimiter(host, min(2, max_limit), max_limit)
+        return limiter
+
+
+class TokenBucket:
+    """限制请求速率，每秒补充rate个令牌，最多攒burst个"""
+
+    def __init__(self, rate, burst=1):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last_time = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last_time) * self._rate, self._burst)
+            self._last_time = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
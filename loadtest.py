@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用本地模拟的服务器压测整个流程，输出每分钟发的图数
+"""
+
+import json
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from asyncio import get_event_loop
+
+from fake_servers import FakeServers
+from main import Pixiv2Weibo
+
+
+async def run(args):
+    servers = FakeServers(port=args.port, latency=args.latency, bandwidth=args.bandwidth,
+                          error_rate=args.error_rate, page_count=args.page_count)
+    await servers.start()
+
+    # 在临时目录里运行，不影响真正的配置和状态
+    old_cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='p2w_loadtest_')
+    os.chdir(work_dir)
+    try:
+        config = {
+            'http':           {'base_urls': servers.base_urls},
+            'retry':          {'base_delay': 0.1, 'max_delay': 1},
+            'cache_dir':      '',
+            'weibo_username': 'loadtest',
+            'weibo_password': 'loadtest',
+            'batch_size':     args.batch_size,
+            'post_gap':       0,
+            'metrics_log':    os.path.join(work_dir, 'metrics.jsonl')
+        }
+        config.update(json.loads(args.config))
+        with open(Pixiv2Weibo.CONFIG_PATH, 'w') as f:
+            json.dump(config, f, indent=2)
+
+        p2w = Pixiv2Weibo()
+        try:
+            start_time = time.monotonic()
+            for _ in range(args.runs):
+                await p2w.start()
+            elapsed = time.monotonic() - start_time
+        finally:
+            await p2w.close()
+    finally:
+        os.chdir(old_cwd)
+        await servers.close()
+
+    print(f'工作目录：{work_dir}')
+    print('服务器统计：', dict(servers.stats))
+    print(f'发了{servers.stats["posts"]}条，用时{elapsed:.2f}秒，'
+          f'每分钟{servers.stats["posts"] / elapsed * 60:.2f}条')
+
+
+def main():
+    parser = ArgumentParser(description='用本地模拟的服务器压测')
+    parser.add_argument('--port', type=int, default=18000, help='模拟服务器的第一个端口')
+    parser.add_argument('--latency', type=float, default=0.05, help='每个请求的延迟秒数')
+    parser.add_argument('--bandwidth', type=int, default=0, help='每个请求的带宽，字节/秒，为0则不限制')
+    parser.add_argument('--error-rate', type=float, default=0., help='返回503的概率')
+    parser.add_argument('--page-count', type=int, default=3, help='每个图的页数')
+    parser.add_argument('--batch-size', type=int, default=10, help='每次运行发几条微博')
+    parser.add_argument('--runs', type=int, default=1, help='运行几次')
+    parser.add_argument('--config', default='{}', help='覆盖配置的JSON')
+    args = parser.parse_args()
+
+    get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,13 @@
 """
 
 import json
+import sys
 from asyncio import get_event_loop
 from io import BytesIO
 
 from PIL import Image
 
+from main import Pixiv2Weibo, get_account_configs
 from weibo import WeiboApi
 
 
@@ -20,12 +22,18 @@ class WeiboApiGui(WeiboApi):
 
 
 async def main():
-    with open('config.json') as f:
-        config = json.load(f)
-    weibo = WeiboApiGui()
-    await weibo.login(config['weibo_username'], config['weibo_password'])
-    weibo.save_cookie('weibo_cookie.pickle')
-    await weibo.close()
+    """登录所有账号，或者参数指定的账号"""
+    with open(Pixiv2Weibo.CONFIG_PATH) as f:
+        config = {**Pixiv2Weibo.DEFAULT_CONFIG, **json.load(f)}
+    for account_config in get_account_configs(config):
+        if len(sys.argv) > 1 and account_config['name'] not in sys.argv[1:]:
+            continue
+        weibo = WeiboApiGui()
+        try:
+            await weibo.login(account_config['username'], account_config['password'])
+            weibo.save_cookie(account_config['cookie_path'])
+        finally:
+            await weibo.close()
 
 
 if __name__ == '__main__':
@@ -2,37 +2,217 @@
 # -*- coding: utf-8 -*-
 
 import json
-from asyncio import get_event_loop, ensure_future, gather, sleep
+import os
+import signal
+import time
+import traceback
+from argparse import ArgumentParser
+from asyncio import (get_event_loop, ensure_future, gather, shield, wait, wait_for, sleep, Event, Semaphore,
+                     TimeoutError)
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from pprint import pprint
 
+from yarl import URL
+
 from anticens import anticens
+from file_cache import FileCache
 from imgcry import encrypt_image
-from pixiv import PixivApi, JP_TZ
-from weibo import WeiboApi
+from limiter import TokenBucket
+from metrics import metrics
+from phash import BKTree, dhash
+from pixiv import PixivApi, JP_TZ, RANKING_CATEGORIES
+from retry import RetryPolicy
+from state_store import StateStore
+from transport import Transport
+from upload_cache import UploadCache
+from weibo import UPLOAD_URL, WeiboApi
+
+
+def _encrypt_image_timed(encrypt, data):
+    """在执行器里运行，返回加密结果和耗时"""
+    start_time = time.monotonic()
+    return encrypt(data), time.monotonic() - start_time
+
+
+# 日本时间中午12点更新排行榜，留10分钟余量
+RANKING_UPDATE_DELAY = timedelta(hours=12, minutes=10)
+
+
+def get_account_configs(config):
+    """返回每个微博账号的配置，没有配置weibo_accounts时用weibo_username、weibo_password作为默认账号"""
+    if not config['weibo_accounts']:
+        return [{
+            'name':               '',
+            'username':           config['weibo_username'],
+            'password':           config['weibo_password'],
+            'cookie_path':        Pixiv2Weibo.WEIBO_COOKIE_PATH,
+            'upload_rate':        config['upload_rate'],
+            'upload_burst':       config['upload_burst'],
+            'weibo_upload_mode':  config['weibo_upload_mode'],
+            'post_gap':           config['post_gap']
+        }]
+    account_configs = []
+    for account_config in config['weibo_accounts']:
+        name = account_config.get('name', account_config['username'])
+        account_configs.append({
+            'name':               name,
+            'cookie_path':        f'weibo_cookie_{name}.pickle',
+            'upload_rate':        config['upload_rate'],
+            'upload_burst':       config['upload_burst'],
+            'weibo_upload_mode':  config['weibo_upload_mode'],
+            'post_gap':           config['post_gap'],
+            **account_config
+        })
+    return account_configs
+
+
+class WeiboAccount:
+    """一个微博账号的登录状态和限速，进度按name保存在StateStore里"""
+
+    def __init__(self, config, transport, retry_policy, session_ttl, upload_cache, store):
+        self.name = config['name']
+        self.username = config['username']
+        self.password = config['password']
+        self.cookie_path = config['cookie_path']
+        self.upload_cache = upload_cache
+        upload_bucket = (TokenBucket(config['upload_rate'], config['upload_burst'])
+                         if config['upload_rate'] > 0 else None)
+        self.weibo = WeiboApi(config['weibo_upload_mode'], transport, retry_policy, session_ttl, upload_cache,
+                              upload_bucket)
+        try:
+            self.weibo.load_cookie(self.cookie_path)
+        except FileNotFoundError:
+            pass
+        self.post_gap = config['post_gap']
+        self.last_post_time = None
+        # 这个账号发过的图的感知哈希
+        self.phash_index = BKTree()
+        for illust_id, hash_ in store.get_hashes(self.name):
+            self.phash_index.add(hash_, illust_id)
 
 
 class Pixiv2Weibo:
     CONFIG_PATH = 'config.json'
-    CACHE_PATH = 'cache.json'
+    CACHE_PATH = 'cache.json'  # 旧版本的状态文件，只用来导入
     WEIBO_COOKIE_PATH = 'weibo_cookie.pickle'
 
+    DEFAULT_CONFIG = {
+        'http':                 {},                  # Transport的参数
+        'retry':                {},                  # RetryPolicy的参数
+        'metrics_log':          '',                  # 各阶段耗时的JSON lines日志，为空则不输出
+        'metrics_prometheus':   '',                  # Prometheus textfile collector的.prom文件，为空则不输出
+        'state_path':           'state.db',
+        'pixiv_cookie':         '',
+        'pixiv_proxy':          '',
+        'cache_dir':            'cache',             # P站图片和排行榜的缓存目录，为空则不缓存
+        'cache_size':           500,                 # 缓存最大MB
+        'spool_max_size':       2 * 1024 * 1024,     # 下载的图片超过这个字节数则写到临时文件
+        'download_concurrency': 4,                   # 最多同时下载几页
+        'ranking_categories':   RANKING_CATEGORIES,  # (mode, content)的列表
+        'ranking_pages':        2,                   # 每类爬几页
+        'ranking_concurrency':  4,                   # 最多同时爬几页
+        'weibo_username':       '',
+        'weibo_password':       '',
+        'weibo_accounts':       [],                  # 多个账号，每个是{"username", "password"}，可以覆盖下面几项
+        'weibo_session_ttl':    6 * 60 * 60,         # 登录状态验证后多少秒内不再验证
+        'upload_concurrency':   3,                   # 最多同时上传几页，会根据延迟和出错自动调整
+        'upload_rate':          0,                   # 每个账号每秒最多开始上传几页，0则不限制
+        'upload_burst':         3,                   # 限速时最多连续上传几页
+        'upload_cache_ttl':     7 * 24 * 60 * 60,    # 上传过的图的pid保留多少秒，重发时不用重新上传，0则不缓存
+        'upload_cache_size':    10000,               # 每个账号最多保存几个pid
+        'weibo_upload_mode':    'multipart',         # multipart或base64
+        'encrypt_mode':         'invert',
+        'encrypt_seed':         114514,
+        'jpeg_max_bytes':       0,                   # 加密后图片的最大字节数，为0则用最高质量
+        'encrypt_executor':     'process',           # process或thread，进程池可以用多核
+        'encrypt_workers':      0,                   # 0则为CPU核数
+        'phash_threshold':      6,                   # 缩略图感知哈希的汉明距离不超过这个值则认为和发过的图相似，-1则不检查
+        'post_interval':        20,                  # 常驻运行时发微博的间隔，分钟
+        'batch_size':           1,                   # 每次运行发几条微博
+        'pipeline_depth':       1,                   # 发微博时最多提前准备几条
+        'prefetch_count':       0,                   # 发完后提前下载、加密每个账号之后的几条，下次运行只要上传，0则不预取
+        'staging_dir':          'staging',           # 预取的加密后图片的目录
+        'staging_size':         200,                 # 预取的最大MB
+        'post_gap':             60                   # 两条微博之间至少间隔的秒数
+    }
+
     def __init__(self):
-        self._config = self._load_json(self.CONFIG_PATH, {
-            'pixiv_cookie':   '',
-            'pixiv_proxy':    '',
-            'weibo_username': '',
-            'weibo_password': ''
+        self._config = {**self.DEFAULT_CONFIG, **self._load_config()}
+        metrics.configure(self._config['metrics_log'], self._config['metrics_prometheus'])
+        self._cache = (FileCache(self._config['cache_dir'], self._config['cache_size'] * 1024 * 1024)
+                       if self._config['cache_dir'] else None)
+        http_config = self._config['http']
+        self._transport = Transport(**{
+            **http_config,
+            'max_concurrency': {URL(UPLOAD_URL).host: self._config['upload_concurrency'],
+                                **http_config.get('max_concurrency', {})}
         })
-        self._pixiv = PixivApi(self._config['pixiv_cookie'], self._config['pixiv_proxy'])
-        self._weibo = WeiboApi()
-        try:
-            self._weibo.load_cookie(self.WEIBO_COOKIE_PATH)
-        except FileNotFoundError:
-            pass
+        self._retry_policy = RetryPolicy(**self._config['retry'])
+        self._pixiv = PixivApi(self._config['pixiv_cookie'], self._config['pixiv_proxy'], self._cache,
+                               self._transport, self._retry_policy, self._config['spool_max_size'])
+        self._store = StateStore(self._config['state_path'])
+        if self._store.import_json_cache(self.CACHE_PATH):
+            print('已导入' + self.CACHE_PATH)
+        # 排行榜、下载和加密所有账号共用，上传和发微博每个账号分别进行
+        self._accounts = [
+            WeiboAccount(account_config, self._transport, self._retry_policy, self._config['weibo_session_ttl'],
+                         self._create_upload_cache(account_config['name']), self._store)
+            for account_config in get_account_configs(self._config)
+        ]
+        # 预取的加密后的图，排行榜更新或者加密参数改变时清空
+        self._staging = (FileCache(self._config['staging_dir'], self._config['staging_size'] * 1024 * 1024)
+                         if self._config['prefetch_count'] > 0 else None)
+        self._executor = self._create_executor()
+        # 下载、加密每个阶段同时处理的页数，上传的由Transport里每个host的AdaptiveLimiter自动调整
+        self._download_semaphore = Semaphore(self._config['download_concurrency'])
+        self._encrypt_semaphore = Semaphore(self._config['encrypt_workers'] or os.cpu_count() or 1)
+        self._ranking = None
+        # illust_id -> 这次运行算过的缩略图感知哈希，失败则为None
+        self._thumbnail_hashes = {}
+
+    def _create_upload_cache(self, account):
+        if self._config['upload_cache_ttl'] <= 0:
+            return None
+        return UploadCache(self._store, account, self._config['upload_cache_ttl'], self._config['upload_cache_size'])
+
+    def _create_executor(self):
+        executor_type = {
+            'process': ProcessPoolExecutor,
+            'thread':  ThreadPoolExecutor
+        }[self._config['encrypt_executor']]
+        return executor_type(self._config['encrypt_workers'] or None)
 
     async def close(self):
-        await gather(self._pixiv.close(), self._weibo.close())
+        await gather(self._pixiv.close(), *(account.weibo.close() for account in self._accounts))
+        if self._cache is not None:
+            print(f'图片缓存命中{self._cache.hits}次，未命中{self._cache.misses}次')
+        for account in self._accounts:
+            cache = account.upload_cache
+            if cache is not None:
+                print(f'账号{account.username}上传缓存命中{cache.hits}次，未命中{cache.misses}次，命中率{cache.hit_rate:.0%}')
+        print(f'新建连接{self._transport.new_connections}个，复用连接{self._transport.reused_connections}次')
+        await self._transport.close()
+        metrics.export_prometheus()
+        if self._retry_policy.retry_counts:
+            print('重试次数：', dict(self._retry_policy.retry_counts))
+        self._executor.shutdown()
+        self._store.close()
+
+    # 旧配置项 -> 新配置项，只有旧的时候用旧的
+    RENAMED_CONFIG = {
+        'image_cache_dir':  'cache_dir',
+        'image_cache_size': 'cache_size'
+    }
+
+    def _load_config(self):
+        config = self._load_json(self.CONFIG_PATH, {})
+        for old_key, key in self.RENAMED_CONFIG.items():
+            if old_key in config and key not in config:
+                config[key] = config[old_key]
+        return config
 
     @staticmethod
     def _load_json(path, default=None):
@@ -44,45 +224,294 @@ class Pixiv2Weibo:
 
     async def start(self):
         # 登录微博
-        login_future = ensure_future(self._weibo.login_if_need(
-            self._config['weibo_username'], self._config['weibo_password']
-        ))
+        login_futures = [
+            ensure_future(account.weibo.login_if_need(account.username, account.password))
+            for account in self._accounts
+        ]
 
-        # 取要发的图信息
-        cache = await self._load_cache()
-        try:
-            image_info = cache['image_info'][cache['next_index']]
-        except IndexError:
+        # 每个账号取要发的图信息，跳过以前发过的和相似的
+        ranking = await self._load_ranking()
+        batches = [await self._select_batch(account, ranking) for account in self._accounts]
+        if not any(batches):
             print('没图了')
+            for login_future in login_futures:
+                login_future.cancel()
             return
-        cache['next_index'] += 1
-        with open(self.CACHE_PATH, 'w') as f:
-            json.dump(cache, f)
-        print('图片信息：')
-        pprint(image_info)
 
-        # 爬图
-        image_data = await self._pixiv.get_image_data(image_info)
-        image_data = map(encrypt_image, filter(lambda x: x, image_data))
-        # for index, data in enumerate(image_data):
-        #     with open(str(index) + '.jpg', 'wb') as f:
-        #         f.write(data)
+        # 所有账号要发的图按排名顺序只准备一次，每个账号都发完才释放
+        image_info_list = sorted({image_info['illust_id']: (index, image_info)
+                                  for batch in batches for index, image_info in batch}.values(),
+                                 key=lambda item: item[0])
+        image_info_list = [image_info for _, image_info in image_info_list]
+        loop = get_event_loop()
+        prepare_futures = {image_info['illust_id']: loop.create_future() for image_info in image_info_list}
+        remaining = Counter(image_info['illust_id'] for batch in batches for _, image_info in batch)
+
+        # 流水线：发第k个的同时爬第k+1个，最多提前准备pipeline_depth个
+        semaphore = Semaphore(self._config['pipeline_depth'] + 1)
+
+        def release(illust_id):
+            remaining[illust_id] -= 1
+            if remaining[illust_id] == 0:
+                semaphore.release()
+
+        producer_future = ensure_future(self._prepare_images(image_info_list, prepare_futures, semaphore))
+        try:
+            results = await gather(*(
+                self._post_images(account, batch, login_future, prepare_futures, release)
+                for account, batch, login_future in zip(self._accounts, batches, login_futures)
+            ), return_exceptions=True)
+            for account, result in zip(self._accounts, results):
+                if isinstance(result, BaseException):
+                    print(f'账号{account.username}出错：')
+                    traceback.print_exception(type(result), result, result.__traceback__)
+            if any(result is True for result in results):
+                await self._prefetch(ranking)
+        finally:
+            producer_future.cancel()
+            for illust_id, prepare_future in prepare_futures.items():
+                if not prepare_future.done():
+                    prepare_future.cancel()
+                elif remaining[illust_id] > 0 and prepare_future.exception() is None:
+                    for page_future in prepare_future.result():
+                        page_future.cancel()
+            self._thumbnail_hashes.clear()
+            metrics.export_prometheus()
+
+    async def _post_images(self, account, batch, login_future, prepare_futures, release):
+        """一个账号按顺序发batch里的图，返回是否发成功过"""
+        pending = [image_info['illust_id'] for _, image_info in batch]
+        any_posted = False
+        try:
+            await login_future
+            account.weibo.save_cookie(account.cookie_path)
+
+            for index, image_info in batch:
+                illust_id = image_info['illust_id']
+                # 等准备好，准备失败的话在下面的try里抛出
+                await wait([prepare_futures[illust_id]])
+                # 开始发了才算用掉，中途退出的话没发的下次还会发
+                self._store.set_next_index(index + 1, account.name)
+                self._store.set_status(illust_id, StateStore.POSTING, account.name)
+                posted = False
+                start_time = time.monotonic()
+                try:
+                    posted = await self._post_image(account, image_info, prepare_futures[illust_id].result())
+                except Exception:
+                    # 失败了跳过这张，继续发下一张
+                    traceback.print_exc()
+                finally:
+                    pending.remove(illust_id)
+                    release(illust_id)
+                metrics.record('illust', time.monotonic() - start_time, posted, illust_id=illust_id,
+                               account=account.username)
+                self._store.set_status(illust_id, StateStore.POSTED if posted else StateStore.FAILED, account.name)
+                any_posted = any_posted or posted
+                # 只算发了的账号发过，其他账号还可以发
+                hash_ = self._thumbnail_hashes.get(illust_id) if posted else None
+                if hash_ is not None:
+                    account.phash_index.add(hash_, illust_id)
+                    self._store.add_hash(illust_id, hash_, account.name)
+            return any_posted
+        finally:
+            # 没发的也要释放，不然其他账号会一直等
+            for illust_id in pending:
+                release(illust_id)
+            # 中途可能重新登录过
+            account.weibo.save_cookie(account.cookie_path)
+
+    async def _select_batch(self, account, ranking):
+        """
+        返回这个账号这次要发的[(排名序号, 图信息)]，跳过发过的和与发过的图相似的。
+        和这次要发的图相似的不跳过，而是这次不再往后取，等前面那张发了下次再判断，前面那张发失败的话这张还能发
+        """
+        batch_size = self._config['batch_size']
+        threshold = self._config['phash_threshold']
+        batch = []
+        batch_hashes = BKTree()
+        index = self._store.get_next_index(account.name)
+        while index < len(ranking) and len(batch) < batch_size:
+            # 每轮取还差的数量的候选，并发下载缩略图
+            candidates = []
+            while index < len(ranking) and len(candidates) < batch_size - len(batch):
+                if not self._store.is_posted(ranking[index]['illust_id'], account.name):
+                    candidates.append((index, ranking[index]))
+                index += 1
+            if threshold >= 0:
+                await gather(*(self._get_thumbnail_hash(image_info) for _, image_info in candidates))
+
+            for candidate in candidates:
+                image_info = candidate[1]
+                illust_id = image_info['illust_id']
+                hash_ = self._thumbnail_hashes.get(illust_id) if threshold >= 0 else None
+                if hash_ is not None:
+                    similar = self._find_similar(account.phash_index, hash_, illust_id)
+                    if similar is not None:
+                        print(f'{illust_id}和发过的{similar}相似，跳过')
+                        self._store.set_status(illust_id, StateStore.DUPLICATE, account.name)
+                        continue
+                    similar = self._find_similar(batch_hashes, hash_, illust_id)
+                    if similar is not None:
+                        print(f'{illust_id}和这次要发的{similar}相似，下次再发')
+                        return batch
+                    batch_hashes.add(hash_, illust_id)
+                batch.append(candidate)
+        return batch
+
+    def _find_similar(self, index, hash_, illust_id):
+        """返回index里和hash_最相似的其他图的illust_id，没有则返回None"""
+        similar = [(distance, illust_id_) for distance, illust_id_ in index.find(hash_, self._config['phash_threshold'])
+                   if illust_id_ != illust_id]
+        return min(similar)[1] if similar else None
+
+    async def _get_thumbnail_hash(self, image_info):
+        """返回排行榜缩略图的感知哈希，失败则返回None。每次运行每张图只算一次，发成功后加到发的账号的phash_index"""
+        illust_id = image_info['illust_id']
+        if illust_id in self._thumbnail_hashes:
+            return self._thumbnail_hashes[illust_id]
+        hash_ = None
+        if 'url' in image_info:
+            try:
+                async with self._download_semaphore:
+                    thumbnail = await self._pixiv.get_image_page(image_info['url'])
+                if thumbnail is not None:
+                    with thumbnail:
+                        hash_ = dhash(thumbnail)
+            except Exception:
+                traceback.print_exc()
+        self._thumbnail_hashes[illust_id] = hash_
+        return hash_
+
+    async def _prepare_images(self, image_info_list, prepare_futures, semaphore):
+        for image_info in image_info_list:
+            await semaphore.acquire()
+            prepare_future = prepare_futures[image_info['illust_id']]
+            try:
+                prepare_future.set_result(await self._prepare_image(image_info))
+            except Exception as e:
+                # 如排行榜的数据格式不对，这张算发失败，继续准备后面的
+                prepare_future.set_exception(e)
+
+    def _get_encrypt(self):
+        return partial(encrypt_image, seed=self._config['encrypt_seed'], mode=self._config['encrypt_mode'],
+                       max_bytes=self._config['jpeg_max_bytes'])
+
+    async def _prepare_image(self, image_info):
+        """开始爬图和加密，返回每页的future，结果为加密后的图，页不存在则为None"""
+        urls = self._pixiv.get_image_urls(image_info)
+        pprint(urls)
+        encrypt = self._get_encrypt()
+        # 每页下载完马上加密，不等其他页
+        return [
+            ensure_future(self._prepare_page(url, encrypt))
+            for url in urls
+        ]
+
+    async def _prepare_page(self, url, encrypt):
+        # 上次运行预取过的只要上传
+        if self._staging is not None:
+            data = self._staging.get(self._get_staging_key(url))
+            if data is not None:
+                return data
+        async with self._download_semaphore:
+            page = await self._pixiv.get_image_page(url)
+        if page is None:
+            return None
+        data, duration = await self._encrypt_page(encrypt, page)
+        metrics.record('encrypt', duration)
+        return data
+
+    def _get_staging_generation(self):
+        """排行榜日期和加密参数，改变了则预取的图作废"""
+        date = self._ranking[0] if self._ranking is not None else ''
+        return (f'{date}:{self._config["encrypt_mode"]}:{self._config["encrypt_seed"]}:'
+                f'{self._config["jpeg_max_bytes"]}')
+
+    def _get_staging_key(self, url):
+        return f'{self._get_staging_generation()}:{url}'
+
+    def _check_staging(self):
+        if self._staging is None:
+            return
+        generation = self._get_staging_generation()
+        if self._store.get_staging_key() != generation:
+            self._staging.clear()
+            self._store.set_staging_key(generation)
+
+    async def _prefetch(self, ranking):
+        """每个账号之后的prefetch_count条提前下载、加密，存到staging"""
+        if self._staging is None:
+            return
+        image_info_list = {}
+        for account in self._accounts:
+            count = 0
+            for image_info in ranking[self._store.get_next_index(account.name):]:
+                if count >= self._config['prefetch_count']:
+                    break
+                if self._store.is_posted(image_info['illust_id'], account.name):
+                    continue
+                image_info_list[image_info['illust_id']] = image_info
+                count += 1
+
+        encrypt = self._get_encrypt()
+        results = await gather(*(
+            self._prefetch_page(url, encrypt)
+            for image_info in image_info_list.values()
+            for url in self._pixiv.get_image_urls(image_info)
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                traceback.print_exception(type(result), result, result.__traceback__)
+        print(f'预取了{sum(result is True for result in results)}页')
+
+    async def _prefetch_page(self, url, encrypt):
+        """返回是否新预取了这页"""
+        key = self._get_staging_key(url)
+        if key in self._staging:
+            return False
+        data = await self._prepare_page(url, encrypt)
+        if data is None:
+            return False
+        self._staging.set(key, data)
+        return True
+
+    async def _encrypt_page(self, encrypt, page):
+        """在执行器里加密，不阻塞事件循环。同时加密的页数不超过worker数，所以同时读到内存里的原图也不超过worker数"""
+        loop = get_event_loop()
+        async with self._encrypt_semaphore:
+            with page:
+                # 进程池不能传文件对象
+                if isinstance(self._executor, ProcessPoolExecutor):
+                    page = page.read()
+                return await loop.run_in_executor(self._executor, _encrypt_image_timed, encrypt, page)
 
-        await login_future
-        self._weibo.save_cookie(self.WEIBO_COOKIE_PATH)
+    async def _post_image(self, account, image_info, encrypt_futures):
+        print(f'账号{account.username}的图片信息：')
+        pprint(image_info)
 
         # 上传
         print('正在上传图片')
-        futures = []
-        for data in image_data:
-            futures.append(ensure_future(self._weibo.upload_image(data)))
-            # 加密同时上传，而不是全部加密后再全部上传
-            await sleep(0)
-        image_ids = await gather(*futures)
+        # 加密完一张就上传一张，而不是全部加密后再全部上传
+        async def upload_image(encrypt_future):
+            # 多个账号共用加密结果，一个账号取消了不能影响其他账号
+            data = await shield(encrypt_future)
+            if data is None:
+                return None
+            return await account.weibo.upload_image(data)
+
+        # gather的结果按页的顺序
+        image_ids = await gather(*(
+            upload_image(future) for future in encrypt_futures
+        ))
         image_ids = list(filter(lambda x: x, image_ids))
         print('image_ids：')
         pprint(image_ids)
 
+        # 两条微博之间至少间隔post_gap秒
+        loop = get_event_loop()
+        if account.last_post_time is not None:
+            await sleep(account.last_post_time + account.post_gap - loop.time())
+
         # 发微博
         text = (
             f'{image_info["rank_cate"]} #{image_info["rank"]} {image_info["title"]}\n'
@@ -90,27 +519,73 @@ class Pixiv2Weibo:
             f'标签：{",".join(image_info["tags"])}\n'
             f'https://www.pixiv.net/member_illust.php?mode=medium&illust_id={image_info["illust_id"]}'
         )
-        await self._weibo.post_weibo(text, image_ids)
+        account.last_post_time = loop.time()
+        if not await account.weibo.post_weibo(text, image_ids):
+            return False
         print('OK')
+        return True
 
-    async def _load_cache(self):
+    async def run_daemon(self):
+        """常驻运行，每post_interval分钟发一次，排行榜更新时马上爬新的排行榜，收到SIGTERM时发完当前的再退出"""
+        loop = get_event_loop()
+        stop_event = Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        interval = self._config['post_interval'] * 60
+        next_post_time = loop.time()
+        while not stop_event.is_set():
+            try:
+                if loop.time() >= next_post_time:
+                    next_post_time = loop.time() + interval
+                    await self.start()
+                else:
+                    await self._load_ranking()
+            except Exception:
+                traceback.print_exc()
+
+            # 等到下次发微博或排行榜更新
+            timeout = min(next_post_time - loop.time(), self._seconds_until_ranking_update() + 1)
+            try:
+                await wait_for(stop_event.wait(), max(timeout, 0))
+            except TimeoutError:
+                pass
+        print('退出')
+
+    @staticmethod
+    def _get_ranking_date():
         # 日本时间中午12点更新
-        date = (datetime.now(JP_TZ) - timedelta(hours=12, minutes=10)).strftime('%Y-%m-%d')
-        cache = self._load_json(self.CACHE_PATH)
-        if cache and cache['date'] == date:
-            return cache
+        return (datetime.now(JP_TZ) - RANKING_UPDATE_DELAY).strftime('%Y-%m-%d')
 
-        cache = {
-            'date':       date,
-            'next_index': 0,
-            'image_info': await self._pixiv.get_image_info()
-        }
-        with open(self.CACHE_PATH, 'w') as f:
-            json.dump(cache, f)
-        return cache
+    @staticmethod
+    def _seconds_until_ranking_update():
+        now = datetime.now(JP_TZ) - RANKING_UPDATE_DELAY
+        next_date = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return (next_date - now).total_seconds()
+
+    async def _load_ranking(self):
+        date = self._get_ranking_date()
+        # 常驻运行时不用每次都读数据库
+        if self._ranking is not None and self._ranking[0] == date:
+            return self._ranking[1]
+        if self._store.get_ranking_date() == date:
+            image_info = self._store.get_ranking(date)
+        else:
+            image_info = await self._pixiv.get_image_info(
+                self._config['ranking_categories'], self._config['ranking_pages'],
+                self._config['ranking_concurrency'], date
+            )
+            self._store.set_ranking(date, image_info)
+        self._ranking = (date, image_info)
+        self._check_staging()
+        return image_info
 
 
 async def main():
+    parser = ArgumentParser()
+    parser.add_argument('--daemon', action='store_true', help='常驻运行，每post_interval分钟发一次')
+    args = parser.parse_args()
+
     anticens.add_hosts([
         'www.pixiv.net',
         'i.pximg.net'
@@ -118,8 +593,13 @@ async def main():
     anticens.enable()
 
     p2w = Pixiv2Weibo()
-    await p2w.start()
-    await p2w.close()
+    try:
+        if args.daemon:
+            await p2w.run_daemon()
+        else:
+            await p2w.start()
+    finally:
+        await p2w.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+
+class Metrics:
+    """记录各阶段耗时和流量，输出JSON lines和Prometheus textfile"""
+
+    def __init__(self):
+        self._log_path = None
+        self._prometheus_path = None
+        # 阶段 -> [总耗时, 次数, 失败次数, 最后一次耗时]
+        self._stages = defaultdict(lambda: [0., 0, 0, 0.])
+        # 方向 -> 字节数
+        self._bytes = defaultdict(int)
+
+    def configure(self, log_path=None, prometheus_path=None):
+        """
+        :param log_path: JSON lines日志路径，为空则不输出
+        :param prometheus_path: Prometheus textfile collector的.prom文件路径，为空则不输出
+        """
+        self._log_path = log_path or None
+        self._prometheus_path = prometheus_path or None
+
+    @contextmanager
+    def span(self, stage, **labels):
+        start_time = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(stage, time.monotonic() - start_time, ok, **labels)
+
+    def record(self, stage, duration, ok=True, **labels):
+        stat = self._stages[stage]
+        stat[0] += duration
+        stat[1] += 1
+        if not ok:
+            stat[2] += 1
+        stat[3] = duration
+        self._log({'type': 'span', 'stage': stage, 'duration': round(duration, 6), 'ok': ok, **labels})
+
+    def add_bytes(self, direction, size):
+        self._bytes[direction] += size
+        self._log({'type': 'bytes', 'direction': direction, 'bytes': size})
+
+    def _log(self, record):
+        if self._log_path is None:
+            return
+        record = {'time': time.time(), **record}
+        with open(self._log_path, 'a') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def export_prometheus(self):
+        if self._prometheus_path is None:
+            return
+        lines = [
+            '# TYPE pixiv2weibo_stage_duration_seconds summary',
+            *(f'pixiv2weibo_stage_duration_seconds_sum{{stage="{stage}"}} {stat[0]}\n'
+              f'pixiv2weibo_stage_duration_seconds_count{{stage="{stage}"}} {stat[1]}'
+              for stage, stat in self._stages.items()),
+            '# TYPE pixiv2weibo_stage_errors_total counter',
+            *(f'pixiv2weibo_stage_errors_total{{stage="{stage}"}} {stat[2]}'
+              for stage, stat in self._stages.items()),
+            '# TYPE pixiv2weibo_stage_last_duration_seconds gauge',
+            *(f'pixiv2weibo_stage_last_duration_seconds{{stage="{stage}"}} {stat[3]}'
+              for stage, stat in self._stages.items()),
+            '# TYPE pixiv2weibo_bytes_total counter',
+            *(f'pixiv2weibo_bytes_total{{direction="{direction}"}} {size}'
+              for direction, size in self._bytes.items()),
+            '# TYPE pixiv2weibo_last_export_timestamp_seconds gauge',
+            f'pixiv2weibo_last_export_timestamp_seconds {time.time()}'
+        ]
+        # textfile collector要求原子替换
+        dir_ = os.path.dirname(os.path.abspath(self._prometheus_path))
+        with NamedTemporaryFile('w', dir=dir_, prefix='.', suffix='.tmp', delete=False) as f:
+            f.write('\n'.join(lines) + '\n')
+        # NamedTemporaryFile是0600的，node_exporter可能是别的用户
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, self._prometheus_path)
+
+
+metrics = Metrics()
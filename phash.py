@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+from PIL import Image
+
+
+def dhash(data, size=8):
+    """返回size*size位的差异哈希，data是图片的bytes或二进制文件对象"""
+    img = Image.open(data if hasattr(data, 'read') else BytesIO(data))
+    img.draft('L', (size + 1, size))
+    img = img.convert('L').resize((size + 1, size), Image.BICUBIC)
+    pixels = list(img.getdata())
+    hash_ = 0
+    for y in range(size):
+        row = pixels[y * (size + 1): (y + 1) * (size + 1)]
+        for x in range(size):
+            hash_ = (hash_ << 1) | (row[x] < row[x + 1])
+    return hash_
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """按汉明距离查找相近哈希的BK树"""
+
+    def __init__(self):
+        # 节点：[哈希, 值, {距离: 子节点}]
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, hash_, value):
+        self._size += 1
+        if self._root is None:
+            self._root = [hash_, value, {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(hash_, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_, value, {}]
+                return
+            node = child
+
+    def find(self, hash_, max_distance):
+        """返回距离不超过max_distance的(距离, 值)列表"""
+        if self._root is None:
+            return []
+        result = []
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(hash_, node[0])
+            if distance <= max_distance:
+                result.append((distance, node[1]))
+            # 三角不等式，只有这些子树里可能有距离不超过max_distance的
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return result
@@ -1,28 +1,76 @@
 # -*- coding: utf-8 -*-
 
-from asyncio import gather
+import json
+from asyncio import gather, Semaphore
 from datetime import datetime, timedelta, timezone
-from pprint import pprint
+from itertools import chain
+from tempfile import SpooledTemporaryFile
 
 from aiohttp import ClientSession
 from yarl import URL
 
+from metrics import metrics
+from retry import RetryPolicy, check_response
+
 JP_TZ = timezone(timedelta(hours=9))
 
+RANKING_CATEGORIES = (
+    ('male', ''),             # 受男性欢迎
+    ('male_r18', ''),         # 受男性欢迎 R18
+    ('daily', 'illust'),      # 今日 插画
+    ('daily_r18', 'illust'),  # 今日 插画 R18
+)
+RANKING_PAGE_SIZE = 50
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 class PixivApi:
-    def __init__(self, cookie, proxy=None):
-        self._session = ClientSession()
+    def __init__(self, cookie, proxy=None, cache=None, transport=None, retry_policy=None,
+                 spool_max_size=2 * 1024 * 1024):
+        """
+        :param proxy: 连接P站用的代理，为空则用transport里的代理
+        :param cache: 缓存图片和排行榜的FileCache，为None则不缓存
+        :param transport: 共用连接池的Transport，为None则用默认的ClientSession
+        :param retry_policy: 请求失败时的RetryPolicy，为None则用默认的
+        :param spool_max_size: 下载的图片超过这个字节数则写到临时文件
+        """
+        self._transport = transport
+        self._session = transport.create_session() if transport is not None else ClientSession()
         self._session.cookie_jar.update_cookies({
             'PHPSESSID': cookie,
         }, URL('https://www.pixiv.net'))
         self._proxy = proxy or None
+        self._cache = cache
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._spool_max_size = spool_max_size
+
+    def _get_proxy(self, url):
+        if self._proxy is not None or self._transport is None:
+            return self._proxy
+        return self._transport.get_proxy(url)
+
+    def _resolve_url(self, url):
+        return self._transport.resolve_url(url) if self._transport is not None else url
 
     async def close(self):
         await self._session.close()
 
-    async def get_image_info(self):
+    async def get_image_info(self, categories=RANKING_CATEGORIES, pages=2, concurrency=4, date=None):
+        """
+        :param categories: (mode, content)的列表
+        :param pages: 每类最多爬几页
+        :param concurrency: 最多同时请求几页
+        :param date: 排行榜日期，有缓存时同一天的页会从缓存读
+        """
+        semaphore = Semaphore(concurrency)
+
         async def get_ranking_page(page, mode, content):
+            cache_key = f'ranking:{date}:{mode}:{content}:{page}'
+            if date is not None and self._cache is not None:
+                data = self._cache.get(cache_key)
+                if data is not None:
+                    return json.loads(data)
+
             params_ = {
                 'mode':    mode,
                 'format':  'json',
@@ -30,27 +78,47 @@ class PixivApi:
             }
             if content:
                 params_['content'] = content
-            async with self._session.get('https://www.pixiv.net/ranking.php', params=params_,
-                                         proxy=self._proxy) as r:
-                data = (await r.json())['contents']
-                # print(data)
+
+            async def fetch():
+                async with semaphore:
+                    url = 'https://www.pixiv.net/ranking.php'
+                    async with self._session.get(self._resolve_url(url), params=params_,
+                                                 proxy=self._get_proxy(url)) as r:
+                        check_response(r)
+                        # 超出范围的页返回400或404
+                        if r.status >= 400:
+                            return None
+                        return await r.json()
+
+            res = await self._retry_policy.call('爬排行榜', fetch)
+            # print(res)
+            if res is None:
+                return None
+            if date is not None and self._cache is not None:
+                self._cache.set(cache_key, json.dumps(res).encode())
+            return res
+
+        async def get_category(mode, content):
             cate = f'{mode} {content}' if content else mode
-            for image_info_ in data:
-                image_info_['rank_cate'] = cate
-            return data
-
-        params = (
-            ('male', ''),             # 受男性欢迎
-            ('male_r18', ''),         # 受男性欢迎 R18
-            ('daily', 'illust'),      # 今日 插画
-            ('daily_r18', 'illust'),  # 今日 插画 R18
-        )
-        # 每类爬2页
-        pages = await gather(*(
-            get_ranking_page(page, *param) for page in range(1, 2) for param in params
-        ))
-        image_info = sum(pages, [])
-        image_info = self._process_image_info(image_info)
+            image_info_ = []
+            for page in range(1, pages + 1):
+                res = await get_ranking_page(page, mode, content)
+                if res is None:
+                    break
+                for info in res['contents']:
+                    info['rank_cate'] = cate
+                image_info_.extend(res['contents'])
+                # 没有下一页了
+                if not res.get('next') or len(res['contents']) < RANKING_PAGE_SIZE:
+                    break
+            return image_info_
+
+        # 每类按顺序爬，各类同时爬
+        with metrics.span('ranking_fetch'):
+            image_info = await gather(*(
+                get_category(*category) for category in categories
+            ))
+        image_info = self._process_image_info(chain.from_iterable(image_info))
         # print(image_info)
         return image_info
 
@@ -67,22 +135,52 @@ class PixivApi:
         image_info = sorted(id_to_info.values(), key=lambda info_: info_['rank'])
         return image_info
 
-    async def get_image_data(self, image_info):
-        async def get_by_url(url_):
-            async with self._session.get(url_, headers={
-                'referer': 'https://www.pixiv.net/member_illust.php'
-            }, proxy=self._proxy) as r_:
-                return await r_.read() if r_.status < 400 else None
-
+    @staticmethod
+    def get_image_urls(image_info):
         date = datetime.fromtimestamp(image_info['illust_upload_timestamp'],
                                       JP_TZ).strftime('%Y/%m/%d/%H/%M/%S')
         illust_id = image_info['illust_id']
         # 最多9图
-        urls = [
+        return [
             f'https://i.pximg.net/img-master/img/{date}/{illust_id}_p{i}_master1200.jpg'
             for i in range(min(9, int(image_info['illust_page_count'])))
         ]
-        pprint(urls)
-        return await gather(*(
-            get_by_url(url) for url in urls
-        ))
+
+    async def get_image_page(self, url):
+        """返回二进制文件对象，页不存在则返回None"""
+        if self._cache is not None:
+            f = self._cache.open(url)
+            if f is not None:
+                return f
+
+        async def download():
+            async with self._session.get(self._resolve_url(url), headers={
+                'referer': 'https://www.pixiv.net/member_illust.php'
+            }, proxy=self._get_proxy(url)) as r:
+                check_response(r)
+                if r.status >= 400:
+                    return None
+                # 分块写到临时文件，超过spool_max_size的才写到磁盘
+                f_ = SpooledTemporaryFile(self._spool_max_size)
+                try:
+                    # 知道放不进内存就直接写磁盘，省得在内存里增长了再复制
+                    if r.content_length is not None and r.content_length > self._spool_max_size:
+                        f_.rollover()
+                    async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f_.write(chunk)
+                except BaseException:
+                    f_.close()
+                    raise
+            metrics.add_bytes('download', f_.tell())
+            f_.seek(0)
+            return f_
+
+        # 重试完还失败则抛出异常，不能少发一张
+        with metrics.span('download'):
+            f = await self._retry_policy.call('下载图片', download)
+        if f is None:
+            return None
+        if self._cache is not None:
+            self._cache.set_file(url, f)
+            f.seek(0)
+        return f
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from aiohttp import ClientConnectorError, ClientError, ServerTimeoutError
+
+
+class RetryableError(Exception):
+    """可以重试的错误，如429、5xx"""
+
+    def __init__(self, message, retry_after=None, status=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+# 这些错误一般是网络问题，可以重试
+RETRYABLE_ERRORS = (RetryableError, ClientError, asyncio.TimeoutError, IOError)
+
+
+def check_response(r):
+    """429和5xx抛出RetryableError"""
+    if r.status == 429 or r.status >= 500:
+        raise RetryableError(f'HTTP {r.status}', parse_retry_after(r.headers.get('Retry-After')), r.status)
+
+
+def is_retryable(e):
+    return isinstance(e, RETRYABLE_ERRORS)
+
+
+def _is_connection_timeout(e):
+    # aiohttp 3.10以后连接超时有单独的异常，之前的版本只能看消息
+    connection_timeout_error = getattr(aiohttp, 'ConnectionTimeoutError', None)
+    if connection_timeout_error is not None:
+        return isinstance(e, connection_timeout_error)
+    return isinstance(e, ServerTimeoutError) and str(e).startswith('Connection timeout')
+
+
+def is_retryable_before_send(e):
+    """
+    给不是幂等的请求用，只重试请求肯定没发出去的错误：连接失败、连接超时、带Retry-After的429。
+    读取超时、断开连接、5xx时服务器可能已经处理了，不能重试
+    """
+    if isinstance(e, RetryableError):
+        return e.status == 429 and e.retry_after is not None
+    return isinstance(e, ClientConnectorError) or _is_connection_timeout(e)
+
+
+def parse_retry_after(value):
+    """返回秒数，解析失败返回None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class RetryPolicy:
+    """指数退避+随机抖动的重试"""
+
+    def __init__(self, max_attempts=5, base_delay=1, max_delay=30, deadline=120):
+        """
+        :param max_attempts: 最多试几次
+        :param base_delay: 第一次重试前等待的最大秒数，之后每次翻倍
+        :param max_delay: 每次重试前最多等待的秒数
+        :param deadline: 从第一次尝试开始最多用的秒数，超过了就不再重试
+        """
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._deadline = deadline
+        # 名字 -> 重试次数
+        self.retry_counts = Counter()
+
+    async def call(self, name, func, *args, retryable=is_retryable, **kwargs):
+        """
+        调用func(*args, **kwargs)，retryable(异常)为True时重试，重试完还失败则抛出最后的异常
+        :param retryable: 判断异常是否可以重试，默认是RETRYABLE_ERRORS
+        """
+        start_time = time.monotonic()
+        for attempt in range(self._max_attempts):
+            try:
+                return await func(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if not retryable(e) or attempt + 1 >= self._max_attempts:
+                    raise
+                delay = self._get_delay(attempt, getattr(e, 'retry_after', None))
+                if time.monotonic() - start_time + delay > self._deadline:
+                    raise
+                self.retry_counts[name] += 1
+                print(f'{name}失败，{delay:.1f}秒后重试：{e!r}')
+                await asyncio.sleep(delay)
+
+    def _get_delay(self, attempt, retry_after=None):
+        # full jitter
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
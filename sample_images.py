@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""测试、压测、模拟服务器共用的固定测试图片"""
+
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+def make_array(width, height, seed=0, noise=16):
+    """返回(高, 宽, 3)的整数数组，渐变加噪声，比纯噪声更像插画。没有裁剪到0~255，可以再往上画东西"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    arr = np.stack([
+        x * 255 // max(width - 1, 1),
+        y * 255 // max(height - 1, 1),
+        (x + y) * 255 // max(width + height - 2, 1)
+    ], axis=2)
+    return arr + rng.randint(-noise, noise + 1, arr.shape)
+
+
+def to_image(arr, mode='RGB'):
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8), 'RGB').convert(mode)
+
+
+def make_image(width, height, mode='RGB', seed=0, noise=16):
+    return to_image(make_array(width, height, seed, noise), mode)
+
+
+def to_jpeg(img, quality=90):
+    f = BytesIO()
+    img.save(f, 'JPEG', quality=quality)
+    return f.getvalue()
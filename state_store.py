@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sqlite3
+import time
+
+
+class StateStore:
+    """保存排行榜、发布进度和每张图的状态"""
+
+    # 图的状态
+    POSTING = 'posting'
+    POSTED = 'posted'
+    FAILED = 'failed'
+    DUPLICATE = 'duplicate'  # 和发过的图相似
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # 旧版本的illust、illust_hash表没有account列，先改名，建好新表后再复制过去
+        migrate_v1 = self._lacks_account_column('illust')
+        if migrate_v1:
+            self._db.execute('ALTER TABLE illust RENAME TO illust_v1')
+        migrate_v2 = self._lacks_account_column('illust_hash')
+        if migrate_v2:
+            self._db.execute('ALTER TABLE illust_hash RENAME TO illust_hash_v1')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS state (
+                key   TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ranking (
+                date      TEXT    NOT NULL,
+                idx       INTEGER NOT NULL,
+                illust_id INTEGER NOT NULL,
+                info      TEXT    NOT NULL,
+                PRIMARY KEY (date, idx)
+            );
+            CREATE TABLE IF NOT EXISTS illust (
+                account    TEXT    NOT NULL DEFAULT '',
+                illust_id  INTEGER NOT NULL,
+                status     TEXT    NOT NULL,
+                updated_at REAL    NOT NULL,
+                PRIMARY KEY (account, illust_id)
+            );
+            CREATE TABLE IF NOT EXISTS post_history (
+                account   TEXT    NOT NULL DEFAULT '',
+                illust_id INTEGER NOT NULL,
+                date      TEXT    NOT NULL,
+                posted_at REAL    NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS post_history_illust_id ON post_history (illust_id);
+            CREATE TABLE IF NOT EXISTS illust_hash (
+                account   TEXT    NOT NULL DEFAULT '',
+                illust_id INTEGER NOT NULL,
+                hash      INTEGER NOT NULL,
+                PRIMARY KEY (account, illust_id)
+            );
+            CREATE TABLE IF NOT EXISTS upload_cache (
+                account     TEXT NOT NULL,
+                hash        TEXT NOT NULL,
+                pid         TEXT NOT NULL,
+                uploaded_at REAL NOT NULL,
+                PRIMARY KEY (account, hash)
+            );
+        ''')
+        if migrate_v1:
+            self._migrate_v1()
+        if migrate_v2:
+            self._migrate_v2()
+
+    def _lacks_account_column(self, table):
+        columns = [row[1] for row in self._db.execute(f'PRAGMA table_info({table})')]
+        return bool(columns) and 'account' not in columns
+
+    def _migrate_v1(self):
+        """旧版本只有一个账号，状态都算到默认账号''上"""
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('INSERT INTO illust (account, illust_id, status, updated_at) '
+                             "SELECT '', illust_id, status, updated_at FROM illust_v1")
+            self._db.execute('DROP TABLE illust_v1')
+            self._db.execute("ALTER TABLE post_history ADD COLUMN account TEXT NOT NULL DEFAULT ''")
+
+    def _migrate_v2(self):
+        """旧版本的感知哈希所有账号共用，都算到默认账号''上"""
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('INSERT INTO illust_hash (account, illust_id, hash) '
+                             "SELECT '', illust_id, hash FROM illust_hash_v1")
+            self._db.execute('DROP TABLE illust_hash_v1')
+
+    def close(self):
+        self._db.close()
+
+    def _get_state(self, key, default=None):
+        row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_state(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def get_ranking_date(self):
+        return self._get_state('ranking_date')
+
+    def get_ranking(self, date):
+        return [
+            json.loads(info) for info, in
+            self._db.execute('SELECT info FROM ranking WHERE date = ? ORDER BY idx', (date,))
+        ]
+
+    def set_ranking(self, date, image_info):
+        """保存新的排行榜，所有账号的next_index归零"""
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM ranking WHERE date = ?', (date,))
+            self._db.executemany('INSERT INTO ranking (date, idx, illust_id, info) VALUES (?, ?, ?, ?)', (
+                (date, index, info['illust_id'], json.dumps(info))
+                for index, info in enumerate(image_info)
+            ))
+            self._set_state('ranking_date', date)
+            self._db.execute("DELETE FROM state WHERE key = 'next_index' OR key LIKE 'next_index:%'")
+
+    @staticmethod
+    def _get_next_index_key(account):
+        # 默认账号''用旧版本的key
+        return f'next_index:{account}' if account else 'next_index'
+
+    def get_next_index(self, account=''):
+        return int(self._get_state(self._get_next_index_key(account), 0))
+
+    def set_next_index(self, next_index, account=''):
+        self._set_state(self._get_next_index_key(account), next_index)
+
+    def get_staging_key(self):
+        return self._get_state('staging_key')
+
+    def set_staging_key(self, staging_key):
+        self._set_state('staging_key', staging_key)
+
+    def is_posted(self, illust_id, account=''):
+        row = self._db.execute('SELECT status FROM illust WHERE account = ? AND illust_id = ?',
+                               (account, illust_id)).fetchone()
+        return row is not None and row[0] == self.POSTED
+
+    def set_status(self, illust_id, status, account=''):
+        now = time.time()
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('INSERT OR REPLACE INTO illust (account, illust_id, status, updated_at) '
+                             'VALUES (?, ?, ?, ?)', (account, illust_id, status, now))
+            if status == self.POSTED:
+                self._db.execute('INSERT INTO post_history (account, illust_id, date, posted_at) VALUES (?, ?, ?, ?)',
+                                 (account, illust_id, self.get_ranking_date(), now))
+
+    def get_hashes(self, account=''):
+        """返回这个账号发过的图的(illust_id, 感知哈希)列表"""
+        # SQLite的INTEGER是有符号64位的
+        return [
+            (illust_id, hash_ & 0xFFFFFFFFFFFFFFFF)
+            for illust_id, hash_ in self._db.execute('SELECT illust_id, hash FROM illust_hash WHERE account = ?',
+                                                     (account,))
+        ]
+
+    def add_hash(self, illust_id, hash_, account=''):
+        if hash_ >= 0x8000000000000000:
+            hash_ -= 0x10000000000000000
+        self._db.execute('INSERT OR REPLACE INTO illust_hash (account, illust_id, hash) VALUES (?, ?, ?)',
+                         (account, illust_id, hash_))
+
+    def get_upload_pid(self, account, hash_, ttl):
+        row = self._db.execute('SELECT pid FROM upload_cache WHERE account = ? AND hash = ? AND uploaded_at >= ?',
+                               (account, hash_, time.time() - ttl)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_upload_pid(self, account, hash_, pid, ttl, max_entries):
+        """保存pid，删除过期的和超过max_entries的最旧的"""
+        now = time.time()
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('INSERT OR REPLACE INTO upload_cache (account, hash, pid, uploaded_at) '
+                             'VALUES (?, ?, ?, ?)', (account, hash_, pid, now))
+            self._db.execute('DELETE FROM upload_cache WHERE uploaded_at < ?', (now - ttl,))
+            self._db.execute('DELETE FROM upload_cache WHERE account = ? AND hash NOT IN ('
+                             'SELECT hash FROM upload_cache WHERE account = ? ORDER BY uploaded_at DESC LIMIT ?)',
+                             (account, account, max_entries))
+
+    def import_json_cache(self, path):
+        """从旧的cache.json导入，已经有数据时不导入。返回是否导入了"""
+        if self.get_ranking_date() is not None:
+            return False
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return False
+
+        self.set_ranking(cache['date'], cache['image_info'])
+        self.set_next_index(cache['next_index'])
+        # next_index之前的当作已经发过了
+        for info in cache['image_info'][:cache['next_index']]:
+            self.set_status(info['illust_id'], self.POSTED)
+        return True
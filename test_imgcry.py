@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import imgcry
+from sample_images import make_image
+
+# 包括不是8的倍数和小于8的
+SIZES = [(1, 1), (7, 9), (8, 8), (17, 23), (64, 40), (101, 77)]
+
+
+class RandomTest(unittest.TestCase):
+    # 把weibo-img-crypto的random.js逐行转写成JS，用node运行得到的结果
+    JS_RANDOM_114514 = [0.6298303848598152, 0.8922469059471041, 0.30431624851189554]
+    JS_SEQUENCES = [
+        (16, 114514,             [10, 14, 6, 1, 4, 5, 13, 9, 11, 12, 8, 0, 3, 2, 15, 7]),
+        (16, -1,                 [11, 15, 4, 5, 2, 10, 12, 0, 14, 3, 13, 7, 6, 8, 9, 1]),
+        (16, 'weibo-img-crypto', [8, 5, 6, 2, 13, 0, 10, 11, 12, 14, 15, 1, 7, 9, 3, 4]),
+        # 超出int32范围的数字按字符串哈希
+        (8,  '2147483648',       [3, 6, 4, 0, 1, 2, 5, 7]),
+        # BMP以外的字符按两个UTF-16码元哈希
+        (8,  '\U0001F600',       [6, 2, 3, 1, 5, 4, 7, 0]),
+        (64, 114514,             [40, 57, 20, 56, 8, 9, 49, 23, 35, 39, 21, 14, 6, 13, 59, 51, 22, 52, 28, 37, 38, 58,
+                                  1, 4, 55, 5, 3, 19, 42, 32, 17, 34, 29, 27, 26, 30, 61, 36, 63, 60, 2, 31, 44, 62,
+                                  16, 50, 0, 45, 46, 15, 47, 24, 12, 18, 43, 53, 7, 10, 54, 25, 41, 11, 33, 48])
+    ]
+
+    def test_same_as_js(self):
+        rng = imgcry.Random(114514)
+        self.assertEqual([rng.random() for _ in range(3)], self.JS_RANDOM_114514)
+        for length, seed, expected in self.JS_SEQUENCES:
+            with self.subTest(length=length, seed=seed):
+                sequence = imgcry.RandomSequence(length, seed)
+                self.assertEqual([sequence.next() for _ in range(length)], expected)
+
+    def test_fast_sequence(self):
+        for length in (0, 1, 2, 7, 64, 1000):
+            for seed in (0, 114514, -1, -0x80000000, 0x7FFFFFFF, 0x80000000, '', 'abc', '\U0001F600'):
+                with self.subTest(length=length, seed=seed):
+                    sequence = imgcry.RandomSequence(length, seed)
+                    self.assertEqual(imgcry._random_sequence(length, seed), [sequence.next() for _ in range(length)])
+
+
+class InvertEngineTest(unittest.TestCase):
+    def assert_same_as_pil(self, engine):
+        for mode in ('RGB', 'L'):
+            for width, height in SIZES:
+                with self.subTest(mode=mode, size=(width, height)):
+                    img = make_image(width, height, mode)
+                    expected = imgcry._invert_blocks_pil(img.copy())
+                    result = engine(img.copy())
+                    self.assertEqual(result.mode, expected.mode)
+                    self.assertEqual(result.size, expected.size)
+                    self.assertEqual(result.tobytes(), expected.tobytes())
+
+    def test_numpy(self):
+        self.assert_same_as_pil(imgcry._invert_blocks_numpy)
+
+    def test_strips(self):
+        self.assert_same_as_pil(imgcry._invert_blocks_strips)
+        # 多条，最后一条不满
+        self.assert_same_as_pil(lambda img: imgcry._invert_blocks_strips(img, 8))
+
+
+class ShuffleTest(unittest.TestCase):
+    def test_round_trip(self):
+        for mode in ('RGB', 'L'):
+            for width, height in SIZES:
+                with self.subTest(mode=mode, size=(width, height)):
+                    img = make_image(width, height, mode)
+                    result = imgcry._unshuffle_blocks(imgcry._shuffle_blocks(img, 114514), 114514)
+                    # 不足8像素的边缘被裁掉，一个完整的块都没有则不变
+                    expected = img if width < 8 or height < 8 else img.crop((0, 0, width // 8 * 8, height // 8 * 8))
+                    self.assertEqual(result.tobytes(), expected.tobytes())
+
+    def test_smaller_than_block(self):
+        for width, height in ((5, 100), (100, 5), (1, 1)):
+            with self.subTest(size=(width, height)):
+                img = make_image(width, height, 'RGB')
+                self.assertEqual(imgcry._shuffle_blocks(img, 114514).tobytes(), img.tobytes())
+                self.assertEqual(imgcry._unshuffle_blocks(img, 114514).tobytes(), img.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+from aiohttp import ClientConnectorError, ServerDisconnectedError, ServerTimeoutError
+
+from retry import RetryableError, RetryPolicy, is_retryable_before_send
+
+
+def make_connector_error():
+    return ClientConnectorError(mock.Mock(host='weibo.com', port=443, ssl=True), ConnectionRefusedError())
+
+
+class RetryableBeforeSendTest(unittest.TestCase):
+    def test_not_sent(self):
+        for e in (make_connector_error(), RetryableError('HTTP 429', 3, 429), RetryableError('HTTP 429', 0, 429)):
+            with self.subTest(e=e):
+                self.assertTrue(is_retryable_before_send(e))
+
+    def test_maybe_sent(self):
+        for e in (ServerDisconnectedError(), asyncio.TimeoutError(),
+                  ServerTimeoutError('Timeout on reading data from socket'), RetryableError('HTTP 503', None, 503),
+                  RetryableError('HTTP 503', 3, 503), RetryableError('HTTP 429', None, 429)):
+            with self.subTest(e=e):
+                self.assertFalse(is_retryable_before_send(e))
+
+    @unittest.skipUnless(hasattr(aiohttp, 'ConnectionTimeoutError'), 'aiohttp 3.10以后才有ConnectionTimeoutError')
+    def test_connection_timeout_error(self):
+        self.assertTrue(is_retryable_before_send(aiohttp.ConnectionTimeoutError('Connection timeout to host x')))
+
+    def test_connection_timeout_message(self):
+        # 旧版本aiohttp（如3.5.4）没有ConnectionTimeoutError，只能看消息
+        with mock.patch.object(aiohttp, 'ConnectionTimeoutError', None, create=True):
+            self.assertTrue(is_retryable_before_send(
+                ServerTimeoutError('Connection timeout to host https://weibo.com/')))
+            self.assertFalse(is_retryable_before_send(ServerTimeoutError('Timeout on reading data from socket')))
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def call(self, errors):
+        """依次抛出errors里的异常，然后返回'ok'，返回(结果或异常, 调用次数, sleep次数)"""
+        attempts = 0
+
+        async def func():
+            nonlocal attempts
+            attempts += 1
+            if attempts <= len(errors):
+                raise errors[attempts - 1]
+            return 'ok'
+
+        with mock.patch('asyncio.sleep', new=mock.AsyncMock()) as sleep:
+            try:
+                result = asyncio.run(RetryPolicy().call('test', func, retryable=is_retryable_before_send))
+            except Exception as e:
+                result = e
+        return result, attempts, sleep.await_count
+
+    def test_no_retry_after_sent(self):
+        for e in (ServerDisconnectedError(), asyncio.TimeoutError(), RetryableError('HTTP 503', 3, 503)):
+            with self.subTest(e=e):
+                self.assertEqual(self.call([e]), (e, 1, 0))
+
+    def test_retry_before_sent(self):
+        self.assertEqual(self.call([make_connector_error(), RetryableError('HTTP 429', 0, 429)]), ('ok', 3, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+from http.cookies import SimpleCookie
+from unittest import mock
+
+from yarl import URL
+
+from weibo import WeiboApi
+
+# 2031-01-01 00:00:00 UTC
+SUB_EXPIRY = 1924992000
+
+
+class CookieExpiryTest(unittest.TestCase):
+    def run_with_api(self, func):
+        async def run():
+            api = WeiboApi()
+            try:
+                func(api)
+            finally:
+                await api.close()
+        asyncio.run(run())
+
+    @staticmethod
+    def add_cookie(api, key, expires, domain='.weibo.com'):
+        cookie = SimpleCookie()
+        cookie[key] = 'x'
+        cookie[key]['expires'] = expires
+        cookie[key]['domain'] = domain
+        api._session.cookie_jar.update_cookies(cookie, URL(f'https://{domain.lstrip(".")}/'))
+
+    def test_saved_jar(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cookie_path = os.path.join(tmp_dir, 'cookie.pickle')
+
+            def save(api):
+                self.add_cookie(api, 'SUB', 'Wed, 01 Jan 2031 00:00:00 GMT')
+                # 别的域名的cookie不算
+                self.add_cookie(api, 'SUB', 'Wed, 01 Jan 2031 00:00:00 GMT', '.example.com')
+                api._validated_at = time.time()
+                self.assertEqual(api._get_cookie_expiry(), SUB_EXPIRY)
+                api.save_cookie(cookie_path)
+
+            def load(api):
+                api.load_cookie(cookie_path)
+                self.assertEqual(api._expires_at, SUB_EXPIRY)
+                self.assertTrue(api._is_session_fresh())
+                with mock.patch('time.time', return_value=SUB_EXPIRY + 1):
+                    api._validated_at = SUB_EXPIRY
+                    self.assertFalse(api._is_session_fresh())
+
+            self.run_with_api(save)
+            with open(os.path.join(tmp_dir, 'cookie.json')) as f:
+                self.assertEqual(json.load(f)['expires_at'], SUB_EXPIRY)
+            self.run_with_api(load)
+
+    def test_expired(self):
+        def check(api):
+            # 过期的cookie会被cookie jar删掉，所以改时间
+            self.add_cookie(api, 'SUB', 'Wed, 01 Jan 2031 00:00:00 GMT')
+            self.add_cookie(api, 'SUBP', 'Wed, 01 Jan 2031 00:00:00 GMT')
+            api._validated_at = time.time()
+            self.assertTrue(api._is_session_fresh())
+            # 刚验证过但cookie过期了
+            with mock.patch('time.time', return_value=SUB_EXPIRY + 1):
+                api._validated_at = SUB_EXPIRY
+                self.assertFalse(api._is_session_fresh())
+            api._validated_at = None
+            self.assertFalse(api._is_session_fresh())
+
+        self.run_with_api(check)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from yarl import URL
+
+from limiter import HostLimiters
+
+
+class Transport:
+    """PixivApi和WeiboApi共用的连接池"""
+
+    def __init__(self, limit=100, limit_per_host=8, keepalive_timeout=30, dns_cache_ttl=300,
+                 connect_timeout=10, read_timeout=60, proxies=None, base_urls=None, max_concurrency=None):
+        """
+        :param limit: 总连接数上限
+        :param limit_per_host: 每个host的连接数上限
+        :param keepalive_timeout: 空闲连接保持的秒数
+        :param dns_cache_ttl: DNS缓存秒数
+        :param connect_timeout: 连接超时秒数
+        :param read_timeout: 读取超时秒数
+        :param proxies: host -> 代理地址，如{"i.pximg.net": "http://127.0.0.1:8080"}
+        :param base_urls: 原来的origin -> 实际请求的origin，如{"https://www.pixiv.net": "http://localhost:8001"}，
+                          用来连接本地的模拟服务器
+        :param max_concurrency: host -> 自适应并发数的上限，其他host的上限为limit_per_host
+        """
+        self._connector = TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                       keepalive_timeout=keepalive_timeout,
+                                       use_dns_cache=True, ttl_dns_cache=dns_cache_ttl)
+        self._timeout = ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self._proxies = proxies or {}
+        self._base_urls = {URL(src).origin(): URL(dst).origin() for src, dst in (base_urls or {}).items()}
+        self._canonical_base_urls = {dst: src for src, dst in self._base_urls.items()}
+        self._limiters = HostLimiters(max_concurrency, limit_per_host)
+
+        self.new_connections = 0
+        self.reused_connections = 0
+        self._trace_config = TraceConfig()
+        self._trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        self._trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+
+    async def close(self):
+        await self._connector.close()
+
+    def create_session(self, **kwargs):
+        """创建共用连接池的ClientSession，每个session有自己的cookie"""
+        return ClientSession(connector=self._connector, connector_owner=False, timeout=self._timeout,
+                             trace_configs=[self._trace_config], **kwargs)
+
+    def get_proxy(self, url):
+        return self._proxies.get(URL(url).host)
+
+    def get_limiter(self, url):
+        """返回url的host的AdaptiveLimiter，所有session共用"""
+        return self._limiters.get(url)
+
+    def resolve_url(self, url):
+        """原来的URL -> 实际请求的URL"""
+        return self._replace_origin(url, self._base_urls)
+
+    def canonical_url(self, url):
+        """实际请求的URL -> 原来的URL"""
+        return self._replace_origin(url, self._canonical_base_urls)
+
+    @staticmethod
+    def _replace_origin(url, origins):
+        if not origins:
+            return url
+        url_ = URL(url)
+        if not url_.is_absolute():
+            return url
+        origin = origins.get(url_.origin())
+        if origin is None:
+            return url
+        return str(origin.join(url_.relative()))
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.new_connections += 1
+        self._on_connected(context)
+
+    async def _on_connection_reuseconn(self, session, context, params):
+        self.reused_connections += 1
+        self._on_connected(context)
+
+    @staticmethod
+    def _on_connected(context):
+        # 请求时传了trace_request_ctx=AdaptiveLimiter.request()的话，从拿到连接开始计时
+        on_connected = getattr(context.trace_request_ctx, 'on_connected', None)
+        if on_connected is not None:
+            on_connected()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+
+class UploadCache:
+    """加密后图片的哈希 -> 上传后的pid，发微博失败重发或者同一张图再发时不用重新上传"""
+
+    def __init__(self, store, account, ttl, max_entries):
+        """
+        :param store: 保存pid的StateStore
+        :param account: 账号名，pid只在同一个账号里用
+        :param ttl: pid保留多少秒
+        :param max_entries: 每个账号最多保存几个pid，超过了删除最旧的
+        """
+        self._store = store
+        self._account = account
+        self._ttl = ttl
+        self._max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    @staticmethod
+    def _get_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, data):
+        """返回pid，没有或者过期了则返回None"""
+        pid = self._store.get_upload_pid(self._account, self._get_hash(data), self._ttl)
+        if pid is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return pid
+
+    def set(self, data, pid):
+        self._store.add_upload_pid(self._account, self._get_hash(data), pid, self._ttl, self._max_entries)
@@ -4,12 +4,19 @@ import asyncio
 import base64
 import binascii
 import json
+import os
 import random
 import re
+import time
+from email.utils import parsedate_to_datetime
 from urllib.parse import quote_plus
 
 import rsa
-from aiohttp import ClientSession, ContentTypeError, ClientError
+from aiohttp import ClientSession, ContentTypeError, FormData
+
+from limiter import HostLimiters
+from metrics import metrics
+from retry import RETRYABLE_ERRORS, RetryableError, RetryPolicy, check_response, is_retryable_before_send
 
 # 修复cookie expire星期不能匹配的BUG
 import http.cookies
@@ -35,26 +42,148 @@ http.cookies.BaseCookie._BaseCookie__parse_string.__defaults__ = (
 )
 
 
+class AuthError(Exception):
+    """登录已失效"""
+
+
+# 发微博返回这些code说明没登录
+AUTH_FAILURE_CODES = ('100002',)
+LOGIN_URL_PREFIXES = ('https://login.sina.com.cn/', 'https://passport.weibo.com/')
+UPLOAD_URL = 'https://picupload.weibo.com/interface/pic_upload.php'
+
+
 class WeiboApi:
-    def __init__(self):
-        self._session = ClientSession()
+    def __init__(self, upload_mode='multipart', transport=None, retry_policy=None, session_ttl=6 * 60 * 60,
+                 upload_cache=None, upload_bucket=None):
+        """
+        :param upload_mode: 上传图片的方式，multipart或base64，multipart失败时会自动改用base64
+        :param transport: 共用连接池的Transport，为None则用默认的ClientSession
+        :param retry_policy: 上传图片、发微博失败时的RetryPolicy，为None则用默认的
+        :param session_ttl: 登录状态验证后多少秒内不再验证
+        :param upload_cache: 保存上传过的图的pid的UploadCache，为None则不缓存
+        :param upload_bucket: 限制上传速率的TokenBucket，为None则不限制
+        """
+        self._transport = transport
+        self._session = transport.create_session() if transport is not None else ClientSession()
+        self._upload_mode = upload_mode
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._upload_cache = upload_cache
+        self._upload_bucket = upload_bucket
+        # 没有Transport时自己管理每个host的并发数
+        self._limiters = HostLimiters() if transport is None else None
+
+        self._session_ttl = session_ttl
+        # 上次验证登录状态成功的时间
+        self._validated_at = None
+        # 保存的登录cookie过期时间
+        self._expires_at = None
+        self._username = None
+        self._password = None
+        self._login_lock = asyncio.Lock()
+        # 每次重新登录加1，用来判断别的协程是否已经重新登录了
+        self._login_generation = 0
 
     async def close(self):
         await self._session.close()
 
+    def _get_proxy(self, url):
+        return self._transport.get_proxy(url) if self._transport is not None else None
+
+    def _resolve_url(self, url):
+        return self._transport.resolve_url(url) if self._transport is not None else url
+
+    def _get_limiter(self, url):
+        return self._transport.get_limiter(url) if self._transport is not None else self._limiters.get(url)
+
+    def _canonical_url(self, url):
+        return self._transport.canonical_url(url) if self._transport is not None else url
+
+    @staticmethod
+    def _get_state_path(cookie_path):
+        return os.path.splitext(cookie_path)[0] + '.json'
+
     def load_cookie(self, path):
         self._session.cookie_jar.load(path)
+        # 登录状态验证时间
+        try:
+            with open(self._get_state_path(path)) as f:
+                state = json.load(f)
+            self._validated_at = state['validated_at']
+            self._expires_at = state.get('expires_at')
+        except (FileNotFoundError, ValueError, KeyError):
+            self._validated_at = self._expires_at = None
 
     def save_cookie(self, path):
         self._session.cookie_jar.save(path)
+        with open(self._get_state_path(path), 'w') as f:
+            json.dump({
+                'validated_at': self._validated_at,
+                'expires_at':   self._get_cookie_expiry() or self._expires_at
+            }, f)
+
+    def _get_login_cookies(self):
+        """返回cookie jar里微博的登录cookie"""
+        # filter_cookies返回的Morsel没有expires、domain属性，只能遍历cookie jar
+        return [morsel for morsel in self._session.cookie_jar
+                if morsel.key in ('SUB', 'SUBP') and morsel['domain'].lstrip('.').endswith('weibo.com')]
+
+    def _get_cookie_expiry(self):
+        """返回微博登录cookie最早的过期时间戳，不知道则返回None"""
+        expiry = None
+        for morsel in self._get_login_cookies():
+            if not morsel['expires']:
+                continue
+            try:
+                expires = parsedate_to_datetime(morsel['expires']).timestamp()
+            except (TypeError, ValueError):
+                continue
+            expiry = expires if expiry is None else min(expiry, expires)
+        return expiry
+
+    def _is_session_fresh(self):
+        if self._validated_at is None or time.time() - self._validated_at > self._session_ttl:
+            return False
+        # 过期的cookie会被cookie jar删掉
+        if not any(morsel.key == 'SUB' for morsel in self._get_login_cookies()):
+            return False
+        # 新版aiohttp加载cookie后Morsel里没有expires，用保存的过期时间
+        expiry = self._get_cookie_expiry() or self._expires_at
+        return expiry is None or time.time() < expiry
 
     async def login_if_need(self, username, password):
-        if not await self.restore_session():
-            await self.login(username, password)
+        """最近验证过登录状态则不验证，上传或发微博时登录失效再重新登录"""
+        self._username = username
+        self._password = password
+        if self._is_session_fresh():
+            return
+        await self._relogin(self._login_generation)
+
+    async def _relogin(self, generation):
+        async with self._login_lock:
+            # 等锁的时候别的协程已经重新登录了
+            if generation != self._login_generation:
+                return
+            self._validated_at = self._expires_at = None
+            if await self.restore_session() or await self.login(self._username, self._password):
+                self._validated_at = time.time()
+            self._login_generation += 1
+
+    async def _call_with_relogin(self, func, *args, **kwargs):
+        """调用func，抛出AuthError时重新登录再试一次"""
+        generation = self._login_generation
+        try:
+            return await func(*args, **kwargs)
+        except AuthError:
+            if self._username is None:
+                raise
+            print('登录已失效，重新登录')
+            await self._relogin(generation)
+            return await func(*args, **kwargs)
 
     async def restore_session(self):
-        async with self._session.get('https://weibo.com/') as r:
-            return await self.__handle_login_page(str(r.url), await r.text())
+        url = 'https://weibo.com/'
+        async with self._session.get(self._resolve_url(url), proxy=self._get_proxy(url)) as r:
+            return await self.__handle_login_page(self._canonical_url(str(r.url)), await r.text())
 
     async def __handle_login_page(self, url, res):
         while True:
@@ -77,11 +206,11 @@ class WeiboApi:
             # 跨域登录广播
             elif url.startswith('https://login.sina.com.cn/crossdomain2.php'):
                 async def cross_domain_callback(url_, i):
-                    async with self._session.get(url_, params={
+                    async with self._get_limiter(url_).request(), self._session.get(self._resolve_url(url_), params={
                         'callback': 'sinaSSOController.doCrossDomainCallBack',
                         'scriptId': 'ssoscript' + str(i),
                         'client': 'ssologin.js(v1.4.2)'
-                    }) as r_:
+                    }, proxy=self._get_proxy(url_)) as r_:
                         await r_.read()
 
                 url_list = re.search(r'setCrossDomainUrlList\((.*?)\);', res)[1]
@@ -107,10 +236,10 @@ class WeiboApi:
                 print(res)
                 return False
 
-            async with self._session.get(next_url, headers={
+            async with self._session.get(self._resolve_url(next_url), headers={
                 'Referer': url  # 访问visitor?a=restore必须带referer
-            }) as r:
-                url = str(r.url)
+            }, proxy=self._get_proxy(next_url)) as r:
+                url = self._canonical_url(str(r.url))
                 res = await r.text()
 
     @staticmethod
@@ -128,7 +257,8 @@ class WeiboApi:
         su = base64.b64encode(quote_plus(username).encode()).decode()
         data = await self._pre_login(su)
 
-        async with self._session.post('https://login.sina.com.cn/sso/login.php', params={
+        url = 'https://login.sina.com.cn/sso/login.php'
+        async with self._session.post(self._resolve_url(url), params={
             'client': 'ssologin.js(v1.4.19)',
         }, data={
             'entry':       'weibo',
@@ -157,26 +287,28 @@ class WeiboApi:
             'returntype':  'META',
             'door':        '' if data['showpin'] == 0
                            else await self._input_verif_code(data['pcid'])
-        }) as r:
-            return await self.__handle_login_page(str(r.url), await r.text())
+        }, proxy=self._get_proxy(url)) as r:
+            return await self.__handle_login_page(self._canonical_url(str(r.url)), await r.text())
 
     async def _pre_login(self, su):
-        async with self._session.get('https://login.sina.com.cn/sso/prelogin.php', params={
+        url = 'https://login.sina.com.cn/sso/prelogin.php'
+        async with self._session.get(self._resolve_url(url), params={
             'entry':    'weibo',
             'callback': 'sinaSSOController.preloginCallBack',
             'su':       su,
             'rsakt':    'mod',
             'checkpin': '1',
             'client':   'ssologin.js(v1.4.18)'
-        }) as r:
+        }, proxy=self._get_proxy(url)) as r:
             return self.__get_jsonp_response(await r.text())
 
     async def _input_verif_code(self, pcid):
-        async with self._session.get('https://login.sina.com.cn/cgi/pin.php', params={
+        url = 'https://login.sina.com.cn/cgi/pin.php'
+        async with self._session.get(self._resolve_url(url), params={
             'r': random.randint(0, 100000000),
             's': '0',
             'p': pcid
-        }) as r:
+        }, proxy=self._get_proxy(url)) as r:
             img_data = await r.read()
         self._show_image(img_data)
         return input('输入验证码：')
@@ -192,40 +324,100 @@ class WeiboApi:
         return res.decode()
 
     async def upload_image(self, data):
-        # 最多试5次
-        for i in range(5):
-            try:
-                async with self._session.post('https://picupload.weibo.com/interface/pic_upload.php', params={
-                    'cb':          'https://weibo.com/aj/static/upimgback.html?_wv=5&callback=STK_ijax_1',
-                    'mime':        'image/jpeg',
-                    'data':        'base64',
-                    'url':         '0',
-                    'markpos':     '1',
-                    'logo':        '',
-                    'nick':        '0',
-                    'marks':       '0',
-                    'app':         'miniblog',
-                    's':           'rdxt',
-                    'pri':         'null',
-                    'file_source': '1'
-                }, data={
-                    'b64_data': base64.b64encode(data).decode()
-                }, allow_redirects=False) as r:
-                    if 'Location' not in r.headers:
-                        continue
-                    res = re.search(r'&pid=(.*?)(&|$)', r.headers['Location'])
-            except (ClientError, IOError, TimeoutError):
-                print('超时')
-                continue
+        # 上传过的同一张图直接用以前的pid
+        if self._upload_cache is not None:
+            pid = self._upload_cache.get(data)
+            if pid is not None:
+                return pid
+        upload_mode = self._upload_mode
+
+        async def upload():
+            nonlocal upload_mode
+            params = {
+                'cb':          'https://weibo.com/aj/static/upimgback.html?_wv=5&callback=STK_ijax_1',
+                'mime':        'image/jpeg',
+                'url':         '0',
+                'markpos':     '1',
+                'logo':        '',
+                'nick':        '0',
+                'marks':       '0',
+                'app':         'miniblog',
+                's':           'rdxt',
+                'pri':         'null',
+                'file_source': '1'
+            }
+            if upload_mode == 'multipart':
+                # 直接传二进制，比base64小1/4，也不用多复制几次
+                body = FormData()
+                body.add_field('pic1', data, filename='pic1.jpg', content_type='image/jpeg')
+                body_size = len(data)
+            else:
+                params['data'] = 'base64'
+                b64_data = base64.b64encode(data).decode()
+                body = {
+                    'b64_data': b64_data
+                }
+                body_size = len(b64_data)
+            if self._upload_bucket is not None:
+                await self._upload_bucket.acquire()
+            # 同时上传的页数根据延迟和出错自动调整
+            async with self._get_limiter(UPLOAD_URL).request(body_size) as request:
+                start_time = time.monotonic()
+                async with self._session.post(self._resolve_url(UPLOAD_URL), params=params, data=body,
+                                              allow_redirects=False, proxy=self._get_proxy(UPLOAD_URL),
+                                              trace_request_ctx=request) as r:
+                    check_response(r)
+                    location = self._canonical_url(r.headers.get('Location', ''))
+                    if location.startswith(LOGIN_URL_PREFIXES):
+                        raise AuthError(location)
+                    res = re.search(r'&pid=(.*?)(&|$)', location)
+                    if res is None:
+                        print(r.headers)
+                        print(await r.text())
+            # 在限流外面判断，返回的格式不对不算拥塞
             if res is None:
-                print(r.headers)
-                print(await r.text())
-                continue
+                upload_mode = self._fallback_upload_mode(upload_mode)
+                raise RetryableError('上传失败')
+            metrics.add_bytes('upload', body_size)
+            self._print_upload_stats(len(data), upload_mode, time.monotonic() - start_time)
             return res[1]
-        return None
+
+        try:
+            with metrics.span('upload'):
+                pid = await self._call_with_relogin(self._retry_policy.call, '上传图片', upload)
+        except (AuthError, *RETRYABLE_ERRORS) as e:
+            print(f'上传图片失败：{e!r}')
+            return None
+        if self._upload_cache is not None:
+            self._upload_cache.set(data, pid)
+        return pid
+
+    @staticmethod
+    def _fallback_upload_mode(upload_mode):
+        if upload_mode == 'multipart':
+            print('multipart上传失败，改用base64')
+        return 'base64'
+
+    @staticmethod
+    def _print_upload_stats(size, upload_mode, elapsed):
+        b64_size = (size + 2) // 3 * 4
+        if upload_mode == 'multipart':
+            saved = b64_size - size
+            # 按同样的速度估算base64多用的时间
+            print(f'上传{size}字节，用时{elapsed:.2f}秒，比base64少{saved}字节，'
+                  f'约省{elapsed * saved / max(size, 1):.2f}秒')
+        else:
+            print(f'上传{b64_size}字节（base64），用时{elapsed:.2f}秒')
 
     async def post_weibo(self, text, image_ids):
-        async with self._session.post('https://weibo.com/aj/mblog/add', params={
+        # 发微博不是幂等的，服务器可能已经发了的错误不能重试，不然会发两条
+        with metrics.span('post'):
+            return await self._call_with_relogin(self._retry_policy.call, '发微博', self._post_weibo,
+                                                 text, image_ids, retryable=is_retryable_before_send)
+
+    async def _post_weibo(self, text, image_ids):
+        url = 'https://weibo.com/aj/mblog/add'
+        async with self._session.post(self._resolve_url(url), params={
             'ajwvr': '6',
         }, data={
             'location':       'v6_content_home',
@@ -247,11 +439,19 @@ class WeiboApi:
             'updata_img_num': len(image_ids),
         }, headers={
             'referer': 'https://weibo.com/'
-        }) as r:
+        }, proxy=self._get_proxy(url)) as r:
+            check_response(r)
+            # 没登录会跳到登录页
+            if self._canonical_url(str(r.url)).startswith(LOGIN_URL_PREFIXES):
+                raise AuthError(str(r.url))
             try:
                 res = await r.json()
             except ContentTypeError:
                 print(await r.text())
-                return
+                return False
+        if res['code'] in AUTH_FAILURE_CODES:
+            raise AuthError(res)
         if res['code'] != '100000':
             print(res)
+            return False
+        return True